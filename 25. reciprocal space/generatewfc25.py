@@ -0,0 +1,200 @@
+from typing import Optional
+import time
+import os
+import logging
+import subprocess
+import numpy as np
+from multiprocessing import Pool
+from berry import log
+
+try:
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.gspace as g
+except:
+    pass
+
+
+class WfcGenerator:
+    def __init__(self,
+                 nk_points: Optional[int] = None ,
+                 bands: Optional[int] = None,
+                 ecutwfc: Optional[float] = None,
+                 logger_name: str = "genwfc",
+                 logger_level: int = logging.INFO,
+                 flush: bool = False
+                ):
+
+        if bands is not None and nk_points is None:
+            raise ValueError("To generate a wavefunction for a single band, you must specify the k-point.")
+
+        os.system("mkdir -p " + m.wfcdirectory)
+        self.outfile = os.path.join(m.wfcdirectory, "wfc_gspace.npz")
+        if nk_points is None:
+            self.nk_points = range(m.nks)
+        elif  bands is None:
+            self.nk_points = nk_points
+            self.bands = range(m.nbnd)
+        else:
+            self.nk_points = nk_points
+            self.bands = bands
+        self.ref_name = m.refname
+        self.ecutwfc = ecutwfc if ecutwfc is not None else g.read_ecutwfc(g.scf_file())
+        self.logger = log(logger_name, "GENERATE WAVE FUNCTIONS", level=logger_level, flush=flush)
+
+
+
+    def run(self):
+        # prints header on the log file
+        self.logger.header()
+
+        # Logs the parameters for the run
+        self._log_run_params()
+
+        # Sets the program used for converting wavefunctions to the real space
+        if m.noncolin:
+            self.k2r_program = "wfck2rFR.x"
+            self.logger.info("\tNoncolinear calculation, will use wfck2rFR.x")
+            self.logger.info("\tReciprocal space storage is only implemented for the nonrelativistic case")
+            self.logger.footer()
+            return
+        else:
+            self.k2r_program = "wfck2r.x"
+            self.logger.info("\tNonrelativistic calculation, will use wfck2r.x")
+
+        # Crystal coordinates of the k-points, used to build the cutoff sphere of each k-point
+        kappa = g.grid_kappa(np.load(os.path.join(m.data_dir, "phase.npy")))
+        miller = g.miller_indices()
+
+        if isinstance(self.nk_points, range):
+            self.logger.info("\n\tWill run for all k-points and bands")
+            self.logger.info(f"\tThere are {m.nks} k-points and {m.nbnd} bands.\n")
+            # Set the command to run
+            shell_cmd = self._get_command(m.nks, 0, m.nbnd)
+
+            # Runs the command
+            result = subprocess.run(shell_cmd, shell=True, capture_output=True, text=True)
+            output = result.stdout
+
+            out1 = self.clean_output(output)
+            psitotal = self.process_large_string_parallel(out1, m.npr)
+            k_slices = {nk: psitotal[m.nr * m.nbnd * nk : m.nr * m.nbnd * (nk + 1)] for nk in self.nk_points}
+            spheres = {nk: g.sphere_index(kappa[nk], self.ecutwfc, miller) for nk in self.nk_points}
+
+            # **Parallel Processing for Each k-point**
+            with Pool(processes=m.npr) as pool:
+                results = pool.starmap(self._wfck2r, [(nk, k_slices[nk], spheres[nk], m.nbnd) for nk in self.nk_points])
+
+            if any(result is None for result in results):
+                    raise ValueError("Some tasks failed. Check your _wfck2r function.")
+
+            # One coefficient block and one index of G-vectors per k-point
+            store = {"kappa": kappa}
+            npw, discarded = [], []
+            for nk, coef, gidx, lost in results:
+                store[f"k0{nk}coef"] = coef
+                store[f"k0{nk}gidx"] = gidx
+                npw.append(len(gidx))
+                discarded.append(lost)
+
+            with open(self.outfile, "wb") as fich:
+                np.savez(fich, **store)
+
+            self.logger.info(f"\n\tPlane waves per k-point: {min(npw)} to {max(npw)} (real space grid: {m.nr})")
+            self.logger.info(f"\tMaximum fraction of the norm discarded: {max(discarded):.3e}")
+            self.logger.info(f"\tWavefunctions saved to file {self.outfile}")
+
+        else:
+            self.logger.info("\tReciprocal space storage is only implemented for all k-points and bands")
+
+        self.logger.info("\n\tRemoving temporary file 'tmp'")
+        os.system(f"rm {os.getcwd()}/tmp")
+        self.logger.info(f"\tRemoving quantum expresso output file '{m.wfck2r}'")
+        os.system(f"rm {os.path.join(os.getcwd(),m.wfck2r)}")
+
+        self.logger.footer()
+
+
+    def _log_run_params(self):
+        self.logger.info(f"\tUnique reference of run: {self.ref_name}")
+        self.logger.info(f"\tWavefunctions will be saved in directory {m.wfcdirectory}")
+        self.logger.info(f"\tDFT files are in directory {m.dftdirectory}")
+        self.logger.info(f"\tThis program will run in {m.npr} processors\n")
+
+        self.logger.info(f"\tTotal number of k-points: {m.nks}")
+        self.logger.info(f"\tNumber of r-points in each direction: {m.nr1} {m.nr2} {m.nr3}")
+        self.logger.info(f"\tTotal number of points in real space: {m.nr}")
+        self.logger.info(f"\tNumber of bands: {m.nbnd}")
+        self.logger.info(f"\tKinetic energy cutoff for wavefunctions: {self.ecutwfc} Ry\n")
+
+        self.logger.info(f"\tPoint choosen for sincronizing phases:  {m.rpoint}\n")
+
+    def clean_output(self, output):
+        trans_table = str.maketrans({")": "j", "(": None})
+        out1 = output.translate(trans_table)
+        out1 = out1.replace(", -", "-").replace(",  ", "+")
+        return out1
+
+    # Function to parse a chunk of the string and convert it to complex values
+    def parse_chunk(self, chunk):
+
+        return np.fromiter((num for num in chunk.split('\n') if num), dtype=complex)
+
+    # Function to process the string in parallel
+    def process_large_string_parallel(self, large_string, num_workers):
+        # Split the large string into chunks that end on a line break, so no number is cut in two
+        chunk_size = max(1, len(large_string) // num_workers)
+        bounds = [0]
+        while bounds[-1] < len(large_string):
+            cut = large_string.find('\n', bounds[-1] + chunk_size)
+            bounds.append(len(large_string) if cut == -1 else cut + 1)
+        chunks = [large_string[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+        # Create a pool of workers for parallel processing
+        with Pool(processes=num_workers) as pool:
+            # Apply the parse_chunk function to each chunk
+            results = pool.map(self.parse_chunk, chunks)
+
+        # Combine the results into a single numpy array
+        return np.concatenate(results)
+
+    def _wfck2r(self, nk_point: int, k_slice: np.ndarray, gidx: np.ndarray, number_of_bands: int):
+
+        # For each band, find the value of the wfc at the specific point rpoint (in real space)
+        psi_rpoint = np.array([k_slice[int(m.rpoint) + m.nr * i] for i in range(number_of_bands)])
+
+        # Calculate the phase at rpoint for all the bands
+        deltaphase = np.arctan2(psi_rpoint.imag, psi_rpoint.real)
+
+        # and the modulus of the wavefunction at the reference point rpoint (
+        # will be used to verify if the wavefunction at rpoint is significantly different from zero)
+        mod_rpoint = np.absolute(psi_rpoint)
+
+        for i in range(number_of_bands):
+            self.logger.debug(f"\t{nk_point:6d}  {i:4d}  {mod_rpoint[i]:12.8f}  {deltaphase[i]:12.8f}   {not mod_rpoint[i] < 1e-5}")
+
+        # Subtract the reference phase for each band
+        psi = k_slice.reshape(number_of_bands, m.nr) * np.exp(-1j * deltaphase)[:, np.newaxis]
+
+        # Back to reciprocal space, keeping only the coefficients inside the cutoff sphere
+        coef, index, discarded = g.compress(psi, gidx)
+        return nk_point, coef, index, discarded
+
+
+    def _get_command(self, nk_points: int, initial_band: int, number_of_bands: int):
+            mpi = "" if m.npr == 1 else f"mpirun -np {m.npr} "
+            command =f"&inputpp prefix = '{m.prefix}',\
+                            outdir = '{m.outdir}',\
+                            first_k = {1},\
+                            last_k = {m.nks},\
+                            first_band = {initial_band + 1},\
+                            last_band = {initial_band + number_of_bands},\
+                            loctave = .true., /"
+            return f'echo "{command}" | {mpi} wfck2r.x > tmp; tail -{m.nr * number_of_bands * m.nks} {m.wfck2r}'
+
+if __name__ == "__main__":
+    x = WfcGenerator()
+    start_time = time.time()
+    x.run()
+    end_time = time.time()
+    print('total generate time:', end_time-start_time)
@@ -0,0 +1,121 @@
+"""Plane-wave (G-space) representation of the phase-fixed wavefunctions.
+
+The real-space grid index used by wfck2r.x and by phase.npy is
+r = i1 + nr1 * (i2 + nr2 * i3), so a band reshaped to (nr3, nr2, nr1) in C order
+is the 3D FFT box.  With QE's convention u(r) = sum_G c(G) exp(iG.r) we have
+    c = fftn(u) / nr        and        u = ifftn(c) * nr
+"""
+
+from typing import Optional, Tuple
+import os
+import re
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+except:
+    pass
+
+
+def fft_shape() -> Tuple[int, int, int]:
+    """Shape of the FFT box, slowest index first."""
+    return (m.nr3, m.nr2, m.nr1)
+
+
+def read_ecutwfc(scf_file: str) -> float:
+    """Reads ecutwfc (in Ry) from the QE scf input file."""
+    with open(scf_file, "r") as f:
+        content = f.read()
+    value = re.search(r"ecutwfc\s*=\s*([0-9.eEdD+-]+)", content).group(1)
+    return float(value.lower().replace("d", "e"))
+
+
+def scf_file() -> str:
+    """Path of the scf input file used in the preprocessing."""
+    name = m.name_scf if m.name_scf.endswith(".in") else m.name_scf + ".in"
+    return os.path.join(m.dftdirectory, name)
+
+
+def grid_kappa(phase: np.ndarray) -> np.ndarray:
+    """Crystal coordinates of every k-point, recovered from phase.npy.
+
+    phase[r, nk] = exp(i k.r), so one step along axis j of the FFT grid picks up
+    exp(2 pi i kappa_j / nr_j), with kappa_j = k.a_j / 2pi.
+    Returns an array of shape (nks, 3) ordered as (a1, a2, a3).
+    """
+    steps = (1, m.nr1, m.nr1 * m.nr2)
+    sizes = (m.nr1, m.nr2, m.nr3)
+    kappa = np.empty((phase.shape[1], 3), dtype=np.float64)
+    for j, (step, size) in enumerate(zip(steps, sizes)):
+        kappa[:, j] = np.angle(phase[step] * phase[0].conj()) * size / (2 * np.pi)
+    return kappa
+
+
+def miller_indices() -> np.ndarray:
+    """Integer G components (g1, g2, g3) of every point of the FFT box, shape (nr, 3)."""
+    g3, g2, g1 = np.meshgrid(
+        np.rint(np.fft.fftfreq(m.nr3) * m.nr3).astype(np.int64),
+        np.rint(np.fft.fftfreq(m.nr2) * m.nr2).astype(np.int64),
+        np.rint(np.fft.fftfreq(m.nr1) * m.nr1).astype(np.int64),
+        indexing="ij",
+    )
+    return np.stack((g1.ravel(), g2.ravel(), g3.ravel()), axis=1)
+
+
+def reciprocal_vectors() -> np.ndarray:
+    """Reciprocal lattice vectors (rows) in 1/bohr, from the lattice vectors in bohr."""
+    a = np.array([m.a1, m.a2, m.a3], dtype=np.float64)
+    return 2 * np.pi * np.linalg.inv(a).T
+
+
+def sphere_index(kappa: np.ndarray, ecutwfc: float, miller: Optional[np.ndarray] = None) -> np.ndarray:
+    """Flat FFT-box indices of the G-vectors with |k+G|^2 <= ecutwfc (Ry = 1/bohr^2)."""
+    if miller is None:
+        miller = miller_indices()
+    kg = (miller + kappa) @ reciprocal_vectors()
+    return np.flatnonzero(np.einsum("ij,ij->i", kg, kg) <= ecutwfc)
+
+
+def to_gspace(psi: np.ndarray) -> np.ndarray:
+    """Plane-wave coefficients on the full FFT box of a (nbnd, nr) real-space block."""
+    box = psi.reshape((-1,) + fft_shape())
+    return (np.fft.fftn(box, axes=(1, 2, 3)) / m.nr).reshape(psi.shape[0], m.nr)
+
+
+def compress(psi: np.ndarray, gidx: np.ndarray, tol: float = 1e-10) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Keeps only the coefficients of a (nbnd, nr) block that are inside the sphere.
+
+    Coefficients outside the sphere whose weight is above round-off (relative to
+    the largest coefficient, ``tol``) are kept as well, so the stored data stays
+    lossless even if the sphere was built with a slightly off cutoff.
+    Returns the coefficients (nbnd, npw), the stored index (npw,) and the
+    fraction of the norm that was discarded.
+    """
+    coef = to_gspace(psi)
+    weight = np.max(np.abs(coef), axis=0)
+    keep = np.zeros(m.nr, dtype=bool)
+    keep[gidx] = True
+    keep |= weight > tol * weight.max()
+    index = np.flatnonzero(keep)
+
+    total = np.sum(np.abs(coef) ** 2)
+    discarded = 1 - np.sum(np.abs(coef[:, index]) ** 2) / total if total > 0 else 0.0
+    return coef[:, index], index, float(discarded)
+
+
+def to_rspace(coef: np.ndarray, gidx: np.ndarray) -> np.ndarray:
+    """Rebuilds the (nbnd, nr) real-space block from the stored coefficients.
+
+    All the bands are scattered into one (nbnd, nr3, nr2, nr1) box and brought to
+    real space with a single batched inverse FFT.
+    """
+    box = np.zeros((coef.shape[0], m.nr), dtype=np.complex128)
+    box[:, gidx] = coef
+    box = box.reshape((-1,) + fft_shape())
+    return (np.fft.ifftn(box, axes=(1, 2, 3)) * m.nr).reshape(coef.shape[0], m.nr)
+
+
+def load_kblock(store, nk: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Coefficients and stored index of k-point nk from an open G-space store."""
+    return store[f"k0{nk}coef"], store[f"k0{nk}gidx"]
@@ -0,0 +1,132 @@
+from multiprocessing import Pool, Array
+from typing import Tuple
+import os
+from time import time
+import ctypes
+import logging
+
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.gspace as g
+    import berry._subroutines.goverlap as go
+except:
+    pass
+
+
+def dot(nk: int, j: int, neighbor: int, jNeighbor: Tuple[np.ndarray]) -> None:
+    start = time()
+
+    with np.load(os.path.join(m.wfcdirectory, "wfc_gspace.npz")) as store:
+        coefnk, gidxnk = g.load_kblock(store, nk)
+        coefnei, gidxnei = g.load_kblock(store, neighbor)
+
+    # not normalized dot product, for all pairs of bands at once
+    dpc[nk, j] = go.overlap(coefnk, go.miller_of(gidxnk), coefnei, go.miller_of(gidxnei), kappa[nk] - kappa[neighbor])
+    dpc[neighbor, jNeighbor] = dpc[nk, j].conj().T
+
+    logger.debug(f"\tFinished of nk: {nk:>4}\tneighbor: {neighbor:>4}\tin: {(time() - start):>4.2f} seconds")
+
+
+def get_point_neighbors(nk: int, j: int) -> None:
+    """Generates the arguments for the pre_connection function."""
+    neighbor = d.neighbors[nk, j]
+    if neighbor != -1 and neighbor > nk:
+        jNeighbor = np.where(d.neighbors[neighbor] == nk)[0][0]
+
+        return (nk, j, neighbor, jNeighbor)
+    return None
+
+
+def validate(edges: list) -> float:
+    """Largest difference between the G-space and the real-space dpc (not normalized) on some edges."""
+    d_phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")))
+    error = 0.0
+    with np.load(os.path.join(m.wfcdirectory, "wfc_gspace.npz")) as store:
+        for nk, j, neighbor, _ in edges:
+            dphase = d_phase[:, nk] * d_phase[:, neighbor].conj()
+            wfcnk = g.to_rspace(*g.load_kblock(store, nk))
+            wfcnei = g.to_rspace(*g.load_kblock(store, neighbor))
+            reference = (wfcnk * dphase) @ wfcnei.conj().T
+            error = max(error, np.max(np.abs(dpc[nk, j] - reference)))
+            logger.debug(f"\tValidated nk: {nk:>4}\tneighbor: {neighbor:>4}\terror: {error:.3e}")
+    return error
+
+
+def run_dot(npr: int = 1, validate_edges: int = 0, logger_name: str = "dot", logger_level: logging = logging.INFO, flush: bool = False):
+    global dpc, logger, kappa
+    logger = log(logger_name, "DOT PRODUCT", level=logger_level, flush=flush)
+
+    if not 0 < npr <= os.cpu_count():
+        raise ValueError(f"npr must be between 1 and {os.cpu_count()}")
+    if m.noncolin:
+        raise ValueError("The reciprocal space dot product is only implemented for the nonrelativistic case")
+
+    logger.header()
+
+    ###########################################################################
+    # 1. DEFINING THE CONSTANTS
+    ###########################################################################
+    DPC_SIZE = m.nks * 2 * m.dimensions * m.nbnd * m.nbnd
+    DPC_SHAPE = (m.nks, 2 * m.dimensions, m.nbnd, m.nbnd)
+
+    ###########################################################################
+    # 2. STDOUT THE PARAMETERS
+    ###########################################################################
+    logger.info(f"\tUnique reference of run: {m.refname}")
+    logger.info(f"\tNumber of processors to use: {npr}")
+    logger.info(f"\tNumber of bands: {m.nbnd}")
+    logger.info(f"\tTotal number of k-points: {m.nks}")
+    logger.info(f"\tTotal number of points in real space: {m.nr}")
+    logger.info(f"\tDirectory where the wfc are: {m.wfcdirectory}\n")
+
+    ###########################################################################
+    # 3. CREATE ALL THE ARRAYS
+    ###########################################################################
+    dpc_base = Array(ctypes.c_double, 2 * DPC_SIZE, lock=False)
+    dpc = np.frombuffer(dpc_base, dtype=np.complex128).reshape(DPC_SHAPE)
+    dp = np.zeros(DPC_SHAPE, dtype=np.float64)
+    with np.load(os.path.join(m.wfcdirectory, "wfc_gspace.npz")) as store:
+        kappa = store["kappa"]
+
+    ###########################################################################
+    # 4. CALCULATE
+    ###########################################################################
+    pre_connection_args = [
+        args
+        for nk in range(m.nks)
+        for j in range(2 * m.dimensions)
+        if (args := get_point_neighbors(nk, j)) is not None
+    ]
+    with Pool(npr) as pool:
+        pool.starmap(dot, pre_connection_args)
+
+    if validate_edges > 0:
+        error = validate(pre_connection_args[:validate_edges])
+        logger.info(f"\tMaximum difference to the real space dot product: {error:.3e} ({validate_edges} edges)")
+
+    dpc /= m.nr         # To normalize the dot product
+    dp = np.abs(dpc)    # Calculate the modulus of the dot product
+
+    ###########################################################################
+    # 5. SAVE OUTPUT
+    ###########################################################################
+    np.save(os.path.join(m.data_dir, "dpc.npy"), dpc)
+    np.save(os.path.join(m.data_dir, "dp.npy"), dp)
+    logger.info(f"\n\tDot products saved to file dpc.npy")
+    logger.info(f"\tDot products modulus saved to file dp.npy")
+
+    ###########################################################################
+    # Finished
+    ###########################################################################
+    logger.footer()
+
+if __name__ == "__main__":
+    start_timef = time()
+    run_dot()
+    end_timef = time()
+    print('total dot time:', end_timef-start_timef)
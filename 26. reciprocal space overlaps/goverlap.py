@@ -0,0 +1,96 @@
+"""Overlaps between neighboring k-points computed from the plane-wave coefficients.
+
+The real-space dot product of dotproduct*.py is
+    dpc[b0, b1] = sum_r exp(i(k-k').r) u_b0k(r) conj(u_b1k'(r))
+On the FFT grid exp(i(k-k').r) = prod_j exp(2 pi i x_j i_j / nr_j), with
+x = kappa_k - kappa_k' in crystal coordinates, so expanding u in plane waves
+    dpc[b0, b1] = sum_{G,G'} c_k[b0, G] conj(c_k'[b1, G']) prod_j D_j(x_j + g_j - g'_j)
+where D_N(y) = sum_{i<N} exp(2 pi i y i / N) is the Dirichlet kernel of the grid.
+Along axes where x_j is an integer D_j is N_j times a delta (a shift of the G
+index), so only G-vectors with matching components along those axes couple.
+This is exact: no real-space wavefunction is ever built.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+except:
+    pass
+
+# Distance to the nearest integer below which a component of x is taken as integer
+INTEGER_TOL = 1e-8
+
+
+def miller_of(gidx: np.ndarray) -> np.ndarray:
+    """Integer G components (g1, g2, g3) of flat FFT-box indices, shape (npw, 3)."""
+    sizes = np.array([m.nr1, m.nr2, m.nr3])
+    n = np.stack((gidx % m.nr1, (gidx // m.nr1) % m.nr2, gidx // (m.nr1 * m.nr2)), axis=1)
+    return np.where(n < (sizes + 1) // 2, n, n - sizes)
+
+
+def dirichlet(y: np.ndarray, n: int) -> np.ndarray:
+    """D_n(y) = sum_{i<n} exp(2 pi i y i / n), for y away from multiples of n."""
+    return np.expm1(2j * np.pi * y) / np.expm1(2j * np.pi * y / n)
+
+
+def split_axes(x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Axes where the phase is a pure G shift (with the shift) and the remaining axes."""
+    shift = np.rint(x)
+    is_shift = np.abs(x - shift) < INTEGER_TOL
+    return np.flatnonzero(is_shift), np.flatnonzero(~is_shift)
+
+
+def overlap(coef0: np.ndarray, miller0: np.ndarray, coef1: np.ndarray, miller1: np.ndarray,
+            x: np.ndarray) -> np.ndarray:
+    """Not normalized (nbnd0, nbnd1) overlap matrix between two k-points.
+
+    coef0, coef1: plane-wave coefficients (nbnd, npw) of k and k'
+    miller0, miller1: integer G components (npw, 3) of the stored coefficients
+    x: kappa_k - kappa_k' (3,)
+    """
+    sizes = np.array([m.nr1, m.nr2, m.nr3])
+    shift_axes, dense_axes = split_axes(x)
+    shift = np.rint(x[shift_axes]).astype(np.int64)
+
+    # G and G' couple only if x_j + g_j - g'_j = 0 (mod nr_j) along every shift axis
+    key0 = _axes_key((miller0[:, shift_axes] + shift) % sizes[shift_axes], sizes[shift_axes])
+    key1 = _axes_key(miller1[:, shift_axes] % sizes[shift_axes], sizes[shift_axes])
+    factor = np.prod(sizes[shift_axes])
+
+    result = np.zeros((coef0.shape[0], coef1.shape[0]), dtype=np.complex128)
+
+    if len(dense_axes) == 0:
+        # Pure G shift: a single inner product over the matching G-vectors
+        order = np.argsort(key1)
+        pos = np.searchsorted(key1, key0, sorter=order).clip(max=len(key1) - 1)
+        match = key1[order[pos]] == key0
+        result += coef0[:, match] @ coef1[:, order[pos[match]]].conj().T
+        return factor * result
+
+    # One small dense kernel per group of G-vectors sharing the shift-axes components
+    order0, order1 = np.argsort(key0, kind="stable"), np.argsort(key1, kind="stable")
+    keys0, start0 = np.unique(key0[order0], return_index=True)
+    keys1, start1 = np.unique(key1[order1], return_index=True)
+    end0, end1 = np.append(start0[1:], len(key0)), np.append(start1[1:], len(key1))
+    common, i0, i1 = np.intersect1d(keys0, keys1, assume_unique=True, return_indices=True)
+
+    for a, b in zip(i0, i1):
+        g0 = order0[start0[a]:end0[a]]
+        g1 = order1[start1[b]:end1[b]]
+        kernel = np.ones((len(g0), len(g1)), dtype=np.complex128)
+        for j in dense_axes:
+            kernel *= dirichlet(x[j] + miller0[g0, j][:, None] - miller1[g1, j][None, :], sizes[j])
+        result += (coef0[:, g0] @ kernel) @ coef1[:, g1].conj().T
+
+    return factor * result
+
+
+def _axes_key(values: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """Single integer key for the components of G along a set of axes."""
+    key = np.zeros(values.shape[0], dtype=np.int64)
+    for j in range(values.shape[1]):
+        key = key * sizes[j] + values[:, j]
+    return key
@@ -0,0 +1,154 @@
+"""Reads the binary wfcN.dat files that Quantum ESPRESSO writes in prefix.save.
+
+Each file is a sequence of Fortran unformatted records (a 4-byte length before
+and after every record):
+    ik, xk(3), ispin, gamma_only, scalef
+    ngw, igwx, npol, nbnd
+    b1(3), b2(3), b3(3)
+    mill(3, igwx)
+    evc(npol * igwx)        one record per band
+write_wfc writes the same layout, so it can be used to build synthetic files;
+`python qe_wfc.py` runs check_roundtrip for the collinear and noncollinear layouts.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+except:
+    pass
+
+
+def wfc_file(nk: int) -> str:
+    """Path of the binary wavefunction of k-point nk (QE counts from 1)."""
+    return os.path.join(m.outdir, f"{m.prefix}.save", f"wfc{nk + 1}.dat")
+
+
+def _records(buffer: bytes):
+    """Iterates over the payloads of the Fortran records in buffer."""
+    pos = 0
+    while pos < len(buffer):
+        size = int(np.frombuffer(buffer, dtype=np.int32, count=1, offset=pos)[0])
+        end = int(np.frombuffer(buffer, dtype=np.int32, count=1, offset=pos + 4 + size)[0])
+        if size != end:
+            raise ValueError(f"Corrupted Fortran record at byte {pos}")
+        yield buffer[pos + 4 : pos + 4 + size]
+        pos += size + 8
+
+
+def read_wfc(filename: str, nbnd: Optional[int] = None) -> Tuple[dict, np.ndarray, np.ndarray]:
+    """Reads a wfcN.dat file.
+
+    Returns the header (dict), the Miller indices (igwx, 3) and the coefficients
+    (nbnd, npol, igwx); only the first nbnd bands are kept if nbnd is given.
+    """
+    with open(filename, "rb") as f:
+        records = _records(f.read())
+
+        first = next(records)
+        header = {
+            "ik": int(np.frombuffer(first, dtype=np.int32, count=1)[0]),
+            "xk": np.frombuffer(first, dtype=np.float64, count=3, offset=4).copy(),
+            "ispin": int(np.frombuffer(first, dtype=np.int32, count=1, offset=28)[0]),
+            "gamma_only": bool(np.frombuffer(first, dtype=np.int32, count=1, offset=32)[0]),
+            "scalef": float(np.frombuffer(first, dtype=np.float64, count=1, offset=36)[0]),
+        }
+        ngw, igwx, npol, nbnd_file = (int(n) for n in np.frombuffer(next(records), dtype=np.int32, count=4))
+        header.update(ngw=ngw, igwx=igwx, npol=npol, nbnd=nbnd_file)
+        header["b"] = np.frombuffer(next(records), dtype=np.float64, count=9).reshape(3, 3).copy()
+        mill = np.frombuffer(next(records), dtype=np.int32, count=3 * igwx).reshape(igwx, 3).astype(np.int64)
+
+        nbnd = nbnd_file if nbnd is None else nbnd
+        evc = np.empty((nbnd, npol, igwx), dtype=np.complex128)
+        for band in range(nbnd):
+            evc[band] = np.frombuffer(next(records), dtype=np.complex128, count=npol * igwx).reshape(npol, igwx)
+
+    return header, mill, evc
+
+
+def write_wfc(filename: str, mill: np.ndarray, evc: np.ndarray, ik: int = 1, xk: np.ndarray = np.zeros(3),
+              b: np.ndarray = np.eye(3), ispin: int = 1, gamma_only: bool = False, scalef: float = 1.0):
+    """Writes mill (igwx, 3) and evc (nbnd, npol, igwx) in the layout of wfcN.dat."""
+    nbnd, npol, igwx = evc.shape
+
+    def record(f, *arrays):
+        payload = b"".join(np.ascontiguousarray(a).tobytes() for a in arrays)
+        size = np.array([len(payload)], dtype=np.int32).tobytes()
+        f.write(size + payload + size)
+
+    with open(filename, "wb") as f:
+        record(f, np.array([ik], dtype=np.int32), np.asarray(xk, dtype=np.float64),
+               np.array([ispin, int(gamma_only)], dtype=np.int32), np.array([scalef], dtype=np.float64))
+        record(f, np.array([igwx, igwx, npol, nbnd], dtype=np.int32))
+        record(f, np.asarray(b, dtype=np.float64))
+        record(f, np.asarray(mill, dtype=np.int32))
+        for band in range(nbnd):
+            record(f, evc[band].astype(np.complex128))
+
+
+def check_roundtrip(npol: int, nbnd: int = 4, igwx: int = 57, seed: int = 0):
+    """Writes a random wfcN.dat with write_wfc and checks that read_wfc gives it back."""
+    rng = np.random.default_rng(seed)
+    mill = rng.integers(-5, 6, size=(igwx, 3))
+    evc = rng.normal(size=(nbnd, npol, igwx)) + 1j * rng.normal(size=(nbnd, npol, igwx))
+    xk, b = rng.normal(size=3), rng.normal(size=(3, 3))
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "wfc1.dat")
+        write_wfc(filename, mill, evc, ik=3, xk=xk, b=b, ispin=2, gamma_only=True, scalef=0.5)
+        header, mill_read, evc_read = read_wfc(filename)
+        _, _, evc_first = read_wfc(filename, nbnd=nbnd - 1)
+
+    expected = dict(ik=3, ispin=2, gamma_only=True, scalef=0.5, ngw=igwx, igwx=igwx, npol=npol, nbnd=nbnd)
+    for key, value in expected.items():
+        if header[key] != value:
+            raise AssertionError(f"Header field {key} is {header[key]}, expected {value}")
+    if not (np.array_equal(header["xk"], xk) and np.array_equal(header["b"], b)):
+        raise AssertionError("xk or b did not survive the round trip")
+    if not np.array_equal(mill_read, mill):
+        raise AssertionError("The Miller indices did not survive the round trip")
+    if not (np.array_equal(evc_read, evc) and np.array_equal(evc_first, evc[:-1])):
+        raise AssertionError("The coefficients did not survive the round trip")
+
+
+def box_index(mill: np.ndarray) -> np.ndarray:
+    """Flat index r = n1 + nr1 * (n2 + nr2 * n3) of each G-vector in the FFT box."""
+    n1, n2, n3 = (mill % np.array([m.nr1, m.nr2, m.nr3])).T
+    return n1 + m.nr1 * (n2 + m.nr2 * n3)
+
+
+def to_rspace(mill: np.ndarray, evc: np.ndarray, gamma_only: bool = False, workers: int = 1) -> np.ndarray:
+    """Periodic part u(r) on the real-space grid, shape (nbnd, npol, nr).
+
+    u(r) = sum_G c(G) exp(iG.r), as written by wfck2r.x.  The bands are split in
+    chunks that are transformed by a batched inverse FFT in `workers` threads.
+    """
+    nbnd, npol, _ = evc.shape
+    box = np.zeros((nbnd * npol, m.nr), dtype=np.complex128)
+    box[:, box_index(mill)] = evc.reshape(nbnd * npol, -1)
+    if gamma_only:
+        # Only half of the sphere is stored, c(-G) = conj(c(G))
+        box[:, box_index(-mill)] = evc.reshape(nbnd * npol, -1).conj()
+    box = box.reshape(nbnd * npol, m.nr3, m.nr2, m.nr1)
+
+    def ifft(chunk: slice):
+        box[chunk] = np.fft.ifftn(box[chunk], axes=(1, 2, 3)) * m.nr
+
+    size = -(-nbnd * npol // workers)
+    chunks = [slice(i, i + size) for i in range(0, nbnd * npol, size)]
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(ifft, chunks))
+
+    return box.reshape(nbnd, npol, m.nr)
+
+
+
+if __name__ == "__main__":
+    for npol in (1, 2):
+        check_roundtrip(npol)
+        print(f"wfcN.dat round trip with npol = {npol}: ok")
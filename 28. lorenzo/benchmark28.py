@@ -0,0 +1,72 @@
+import argparse
+import bz2
+import gzip
+import io
+import lzma
+import time
+
+import numpy as np
+
+from lorenzo import encode_block, decode_block
+
+# ---------- Generic compressors (variants 1. to 4.) ----------
+
+def savez_compressed(psi):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, psi)
+    return buffer.getvalue()
+
+def savez_compressed_load(data):
+    return np.load(io.BytesIO(data))["arr_0"]
+
+GENERIC = {
+    "savez_compressed": (savez_compressed, savez_compressed_load),
+    "gzip": (lambda psi: gzip.compress(psi.tobytes()), lambda b: np.frombuffer(gzip.decompress(b), dtype=np.complex128)),
+    "bz2": (lambda psi: bz2.compress(psi.tobytes()), lambda b: np.frombuffer(bz2.decompress(b), dtype=np.complex128)),
+    "lzma": (lambda psi: lzma.compress(psi.tobytes()), lambda b: np.frombuffer(lzma.decompress(b), dtype=np.complex128)),
+}
+
+# ---------- Main ----------
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("psi_file", help="Path to wfc.npy (all k-points and bands in one array, as in 7. save)")
+    ap.add_argument("--grid", type=int, nargs=3, required=True, metavar=("NR1", "NR2", "NR3"), help="Real space grid")
+    ap.add_argument("--nbnd", type=int, required=True, help="Number of bands per k-point")
+    ap.add_argument("--kpoints", type=int, default=1, help="Number of k-points to use")
+    args = ap.parse_args()
+
+    nr1, nr2, nr3 = args.grid
+    shape = (nr3, nr2, nr1)
+    nr = nr1 * nr2 * nr3
+
+    wfc = np.load(args.psi_file, mmap_mode="r")
+    blocks = [np.array(wfc[nk * args.nbnd * nr : (nk + 1) * args.nbnd * nr]).reshape(args.nbnd, nr)
+              for nk in range(args.kpoints)]
+    raw = sum(block.nbytes for block in blocks)
+    print(f"Loaded {args.kpoints} k-points of {args.psi_file}: {raw} bytes")
+
+    methods = {name: (lambda b, c=c: c(b.ravel()), lambda d, shape_, u=u: u(d).reshape(shape_))
+               for name, (c, u) in GENERIC.items()}
+    for compressor in ("zlib", "bz2", "lzma"):
+        methods[f"lorenzo+{compressor}"] = (
+            lambda b, c=compressor: encode_block(b, shape, c).tobytes(),
+            lambda d, shape_, c=compressor: decode_block(np.frombuffer(d, dtype=np.uint8), shape_[0], shape, c),
+        )
+
+    # Report
+    for name, (compress, decompress) in methods.items():
+        start = time.time()
+        data = [compress(block) for block in blocks]
+        encode_time = time.time() - start
+
+        start = time.time()
+        back = [decompress(d, block.shape) for d, block in zip(data, blocks)]
+        decode_time = time.time() - start
+
+        lossless = all(np.array_equal(b.view(np.uint64), block.view(np.uint64)) for b, block in zip(back, blocks))
+        size = sum(len(d) for d in data)
+        print(f"{name:20s} | ratio: {raw / size:6.3f} | encode: {encode_time:8.3f} s | decode: {decode_time:8.3f} s | lossless: {lossless}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Lossless predictive (Lorenzo) compression of wavefunctions on the 3D real-space grid.
+
+Every value f[i3, i2, i1] is predicted from its already coded neighbors
+    p = f[-1,0,0] + f[0,-1,0] + f[0,0,-1] - f[-1,-1,0] - f[-1,0,-1] - f[0,-1,-1] + f[-1,-1,-1]
+(points outside the grid count as zero).  The residual is the difference of the
+float64 bit patterns of f and p, mapped to integers that are monotonic in the
+float value, so it is small when the prediction is good and the decoder rebuilds
+the exact bits.  Residuals are zigzag encoded, split in byte planes and passed
+to a generic compressor.
+
+Encoding is one vectorized pass.  Decoding goes through the wavefronts
+i1 + i2 + i3 = const, whose neighbors all lie on previous wavefronts.
+"""
+
+from typing import Tuple
+import bz2
+import lzma
+import zlib
+
+import numpy as np
+
+SIGN = np.uint64(1 << 63)
+
+COMPRESSORS = {
+    "zlib": (lambda b: zlib.compress(b, 6), zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def ordered(bits: np.ndarray) -> np.ndarray:
+    """Maps float64 bit patterns to unsigned integers with the same ordering as the floats."""
+    return np.where(bits & SIGN, ~bits, bits | SIGN)
+
+
+def unordered(key: np.ndarray) -> np.ndarray:
+    """Inverse of ordered."""
+    return np.where(key & SIGN, key & ~SIGN, ~key)
+
+
+def pack(residual: np.ndarray, compressor: str = "zlib") -> bytes:
+    """Zigzag encodes uint64 residuals (taken as signed), splits them in byte planes and compresses."""
+    signed = np.ascontiguousarray(residual).reshape(-1).view(np.int64)
+    zigzag = ((signed << 1) ^ (signed >> 63)).view(np.uint64)
+
+    # byte planes: the first byte of every residual together, and so on
+    planes = zigzag.view(np.uint8).reshape(-1, 8).T
+    return COMPRESSORS[compressor][0](np.ascontiguousarray(planes).tobytes())
+
+
+def unpack(data: bytes, compressor: str = "zlib") -> np.ndarray:
+    """Inverse of pack, returns the flat uint64 residuals."""
+    planes = np.frombuffer(COMPRESSORS[compressor][1](data), dtype=np.uint8).reshape(8, -1)
+    zigzag = np.ascontiguousarray(planes.T).view(np.uint64).reshape(-1)
+    return (zigzag >> np.uint64(1)) ^ (np.uint64(0) - (zigzag & np.uint64(1)))
+
+
+def _predict(a, b, c, ab, ac, bc, abc):
+    """Lorenzo predictor; the same operation order is used when encoding and decoding."""
+    return a + b + c - ab - ac - bc + abc
+
+
+def _neighbors(padded: np.ndarray):
+    """The seven coded neighbors of every grid point, from the zero padded grid (..., n3+1, n2+1, n1+1)."""
+    return (padded[..., 1:, 1:, :-1], padded[..., 1:, :-1, 1:], padded[..., :-1, 1:, 1:],
+            padded[..., 1:, :-1, :-1], padded[..., :-1, 1:, :-1], padded[..., :-1, :-1, 1:],
+            padded[..., :-1, :-1, :-1])
+
+
+def _wavefronts(shape: Tuple[int, int, int]):
+    """Flat indices of the grid points (and of their neighbors in the padded grid) per wavefront."""
+    n3, n2, n1 = shape
+    p2, p1 = n2 + 1, n1 + 1
+    i3, i2, i1 = np.indices(shape).reshape(3, -1)
+    order = np.argsort(i1 + i2 + i3, kind="stable")
+    bounds = np.searchsorted((i1 + i2 + i3)[order], np.arange(n1 + n2 + n3 - 1))
+    bounds = np.append(bounds, len(order))
+
+    padded = (i3 + 1) * p2 * p1 + (i2 + 1) * p1 + (i1 + 1)
+    offsets = np.array([1, p1, p2 * p1, p1 + 1, p2 * p1 + 1, p2 * p1 + p1, p2 * p1 + p1 + 1])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        points = order[start:end]
+        yield points, padded[points], padded[points][:, None] - offsets[None, :]
+
+
+def encode(values: np.ndarray, shape: Tuple[int, int, int], compressor: str = "zlib") -> bytes:
+    """Compresses a float64 array of shape (nbatch, n3, n2, n1), or anything that reshapes to it."""
+    grid = np.ascontiguousarray(values, dtype=np.float64).reshape((-1,) + tuple(shape))
+    padded = np.zeros((grid.shape[0],) + tuple(n + 1 for n in shape), dtype=np.float64)
+    padded[:, 1:, 1:, 1:] = grid
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        prediction = _predict(*_neighbors(padded))
+    return pack(ordered(grid.view(np.uint64)) - ordered(prediction.view(np.uint64)), compressor)
+
+
+def decode(data: bytes, nbatch: int, shape: Tuple[int, int, int], compressor: str = "zlib") -> np.ndarray:
+    """Inverse of encode, returns a float64 array of shape (nbatch, n3 * n2 * n1)."""
+    size = int(np.prod(shape))
+    residual = unpack(data, compressor).reshape(nbatch, size)
+
+    padded = np.zeros((nbatch, int(np.prod([n + 1 for n in shape]))), dtype=np.float64)
+    for points, target, neighbors in _wavefronts(shape):
+        with np.errstate(over="ignore", invalid="ignore"):
+            prediction = _predict(*(padded[:, neighbors[:, i]] for i in range(7)))
+        key = ordered(prediction.view(np.uint64)) + residual[:, points]
+        padded[:, target] = unordered(key).view(np.float64)
+
+    n3, n2, n1 = shape
+    return padded.reshape(nbatch, n3 + 1, n2 + 1, n1 + 1)[:, 1:, 1:, 1:].reshape(nbatch, size)
+
+
+def encode_block(psi: np.ndarray, shape: Tuple[int, int, int], compressor: str = "zlib") -> np.ndarray:
+    """Compresses a (nbnd, nr) complex block; real and imaginary parts are predicted separately."""
+    parts = np.concatenate((psi.real, psi.imag))
+    return np.frombuffer(encode(parts, shape, compressor), dtype=np.uint8)
+
+
+def decode_block(data: np.ndarray, nbnd: int, shape: Tuple[int, int, int], compressor: str = "zlib") -> np.ndarray:
+    """Inverse of encode_block."""
+    parts = decode(data.tobytes(), 2 * nbnd, shape, compressor)
+    psi = np.empty((nbnd, parts.shape[1]), dtype=np.complex128)
+    psi.real, psi.imag = parts[:nbnd], parts[nbnd:]
+    return psi
@@ -0,0 +1,84 @@
+"""Delta encoding of the phase-fixed wavefunctions between neighboring k-points.
+
+The k-points are visited in grid order and each one is predicted by an already
+stored neighbor (its parent, taken from d.neighbors): the one before it along the
+row or, at the start of a row, the one before it along the column.  Only the
+difference of the float64 bit patterns to the parent is stored (lossless, see
+lorenzo.py).  Every `interval` steps along a chain a k-point is stored on its
+own (keyframe, with the spatial predictor), so reading any k-point decodes at
+most one keyframe and interval - 1 differences.
+"""
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.lorenzo as lz
+except:
+    pass
+
+
+def parents(interval: int) -> np.ndarray:
+    """Parent of every k-point in the chains, -1 for keyframes."""
+    parent = np.full(m.nks, -1, dtype=np.int64)
+    depth = np.zeros(m.nks, dtype=np.int64)
+    for nk in range(m.nks):
+        backward = d.neighbors[nk][(d.neighbors[nk] >= 0) & (d.neighbors[nk] < nk)]
+        if len(backward) == 0:
+            continue
+        candidate = backward.max()
+        if depth[candidate] + 1 < interval:
+            parent[nk] = candidate
+            depth[nk] = depth[candidate] + 1
+    return parent
+
+
+def encode_delta(psi: np.ndarray, reference: np.ndarray, compressor: str = "zlib") -> np.ndarray:
+    """Lossless difference of a (nbnd, nr) complex block to the block of its parent."""
+    key = lz.ordered(psi.view(np.uint64))
+    return np.frombuffer(lz.pack(key - lz.ordered(reference.view(np.uint64)), compressor), dtype=np.uint8)
+
+
+def decode_delta(data: np.ndarray, reference: np.ndarray, compressor: str = "zlib") -> np.ndarray:
+    """Inverse of encode_delta."""
+    key = lz.ordered(reference.view(np.uint64)) + lz.unpack(data.tobytes(), compressor).reshape(reference.shape[0], -1)
+    return lz.unordered(key).view(np.complex128).reshape(reference.shape)
+
+
+def encode_store(psi: Dict[int, np.ndarray], parent: np.ndarray, shape: Tuple[int, int, int],
+                 compressor: str = "zlib") -> dict:
+    """Keyframes and differences for all the k-points, ready for np.savez."""
+    store = {"parent": parent, "shape": np.array(shape), "compressor": np.array(compressor)}
+    for nk in range(len(parent)):
+        if parent[nk] == -1:
+            store[f"k0{nk}"] = lz.encode_block(psi[nk], shape, compressor)
+        else:
+            store[f"k0{nk}"] = encode_delta(psi[nk], psi[parent[nk]], compressor)
+    return store
+
+
+def load_kblock(store, nk: int, cache: Optional[Dict[int, np.ndarray]] = None) -> np.ndarray:
+    """(nbnd, nr) block of k-point nk, decoded from its keyframe along the chain.
+
+    Decoded blocks are kept in `cache` (if given), so neighbors that share a
+    chain are not decoded twice.
+    """
+    cache = {} if cache is None else cache
+    parent = store["parent"]
+    shape, compressor = tuple(store["shape"]), str(store["compressor"])
+
+    chain = [nk]
+    while chain[-1] not in cache and parent[chain[-1]] != -1:
+        chain.append(parent[chain[-1]])
+
+    for k in reversed(chain):
+        if k in cache:
+            continue
+        if parent[k] == -1:
+            cache[k] = lz.decode_block(store[f"k0{k}"], m.nbnd, shape, compressor)
+        else:
+            cache[k] = decode_delta(store[f"k0{k}"], cache[parent[k]], compressor)
+    return cache[nk]
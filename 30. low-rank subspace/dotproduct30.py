@@ -0,0 +1,157 @@
+from multiprocessing import Pool, Array
+from typing import Tuple
+import os
+from time import time
+import ctypes
+import logging
+
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.lowrank as lr
+except:
+    pass
+
+
+def middle(p: int, q: int, nk: int, neighbor: int) -> np.ndarray:
+    """Reduced overlap kernel between patches p and q, with the phase of the edge (nk, neighbor)."""
+    start = time()
+
+    dphase = d_phase[:, nk] * d_phase[:, neighbor].conj()
+    with np.load(os.path.join(m.wfcdirectory, "wfc_lowrank.npz")) as store:
+        kernel = lr.middle_matrix(store[f"p{p}basis"], store[f"p{q}basis"], dphase)
+
+    logger.debug(f"\tFinished kernel of patches: {p:>4} {q:>4}\tin: {(time() - start):>4.2f} seconds")
+    return kernel
+
+
+def dot(nk: int, j: int, neighbor: int, jNeighbor: int, kernel: np.ndarray) -> None:
+    # not normalized dot product, for all pairs of bands at once
+    dpc[nk, j] = coef[nk] @ kernel @ coef[neighbor].conj().T
+    dpc[neighbor, jNeighbor] = dpc[nk, j].conj().T
+
+
+def dot_exact(nk: int, j: int, neighbor: int, jNeighbor: int) -> None:
+    start = time()
+
+    dphase = d_phase[:, nk] * d_phase[:, neighbor].conj()
+    with np.load(os.path.join(m.wfcdirectory, "wfc_lowrank.npz")) as store:
+        wfcnk = coef[nk] @ store[f"p{patch[nk]}basis"] + store[f"k0{nk}res"]
+        wfcnei = coef[neighbor] @ store[f"p{patch[neighbor]}basis"] + store[f"k0{neighbor}res"]
+
+    dpc[nk, j] = (wfcnk * dphase) @ wfcnei.conj().T
+    dpc[neighbor, jNeighbor] = dpc[nk, j].conj().T
+
+    logger.debug(f"\tFinished of nk: {nk:>4}\tneighbor: {neighbor:>4}\tin: {(time() - start):>4.2f} seconds")
+
+
+def get_point_neighbors(nk: int, j: int) -> None:
+    """Generates the arguments for the pre_connection function."""
+    neighbor = d.neighbors[nk, j]
+    if neighbor != -1 and neighbor > nk:
+        jNeighbor = np.where(d.neighbors[neighbor] == nk)[0][0]
+
+        return (nk, j, neighbor, jNeighbor)
+    return None
+
+
+def run_dot(npr: int = 1, exact: bool = False, logger_name: str = "dot", logger_level: logging = logging.INFO, flush: bool = False):
+    global dpc, logger, d_phase, coef, patch
+    logger = log(logger_name, "DOT PRODUCT", level=logger_level, flush=flush)
+
+    if not 0 < npr <= os.cpu_count():
+        raise ValueError(f"npr must be between 1 and {os.cpu_count()}")
+    if m.noncolin:
+        raise ValueError("The low-rank dot product is only implemented for the nonrelativistic case")
+
+    logger.header()
+
+    ###########################################################################
+    # 1. DEFINING THE CONSTANTS
+    ###########################################################################
+    DPC_SIZE = m.nks * 2 * m.dimensions * m.nbnd * m.nbnd
+    DPC_SHAPE = (m.nks, 2 * m.dimensions, m.nbnd, m.nbnd)
+
+    ###########################################################################
+    # 2. STDOUT THE PARAMETERS
+    ###########################################################################
+    logger.info(f"\tUnique reference of run: {m.refname}")
+    logger.info(f"\tNumber of processors to use: {npr}")
+    logger.info(f"\tNumber of bands: {m.nbnd}")
+    logger.info(f"\tTotal number of k-points: {m.nks}")
+    logger.info(f"\tTotal number of points in real space: {m.nr}")
+    logger.info(f"\tDirectory where the wfc are: {m.wfcdirectory}")
+    logger.info(f"\tOverlaps from the full wavefunctions (basis + residual): {exact}\n")
+
+    ###########################################################################
+    # 3. CREATE ALL THE ARRAYS
+    ###########################################################################
+    dpc_base = Array(ctypes.c_double, 2 * DPC_SIZE, lock=False)
+    dpc = np.frombuffer(dpc_base, dtype=np.complex128).reshape(DPC_SHAPE)
+    dp = np.zeros(DPC_SHAPE, dtype=np.float64)
+    d_phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")))
+    with np.load(os.path.join(m.wfcdirectory, "wfc_lowrank.npz")) as store:
+        patch = store["patch"]
+        resnorm = store["resnorm"]
+        coef = {nk: store[f"k0{nk}coef"] for nk in range(m.nks)}
+        has_residual = "k00res" in store.files
+
+    if exact and not has_residual:
+        raise ValueError("The residuals were not stored, the exact dot product is not available")
+
+    ###########################################################################
+    # 4. CALCULATE
+    ###########################################################################
+    pre_connection_args = [
+        args
+        for nk in range(m.nks)
+        for j in range(2 * m.dimensions)
+        if (args := get_point_neighbors(nk, j)) is not None
+    ]
+
+    if exact:
+        with Pool(npr) as pool:
+            pool.starmap(dot_exact, pre_connection_args)
+    else:
+        # One reduced kernel per pair of patches and direction, shared by all their edges
+        groups = {}
+        for args in pre_connection_args:
+            nk, j, neighbor, _ = args
+            groups.setdefault((patch[nk], patch[neighbor], j), []).append(args)
+        with Pool(npr) as pool:
+            kernels = pool.starmap(middle, [(p, q, edges[0][0], edges[0][2]) for (p, q, _), edges in groups.items()])
+
+        bound = 0.0
+        for kernel, edges in zip(kernels, groups.values()):
+            for nk, j, neighbor, jNeighbor in edges:
+                dot(nk, j, neighbor, jNeighbor, kernel)
+                bound = max(bound, np.max(lr.error_bound(resnorm[nk], resnorm[neighbor])))
+
+        logger.info(f"\tReduced kernels: {len(groups)} for {len(pre_connection_args)} edges")
+        logger.info(f"\tBound for the error of the normalized dot products: {bound / m.nr:.3e}")
+
+    dpc /= m.nr         # To normalize the dot product
+    dp = np.abs(dpc)    # Calculate the modulus of the dot product
+
+    ###########################################################################
+    # 5. SAVE OUTPUT
+    ###########################################################################
+    np.save(os.path.join(m.data_dir, "dpc.npy"), dpc)
+    np.save(os.path.join(m.data_dir, "dp.npy"), dp)
+    logger.info(f"\n\tDot products saved to file dpc.npy")
+    logger.info(f"\tDot products modulus saved to file dp.npy")
+
+    ###########################################################################
+    # Finished
+    ###########################################################################
+    logger.footer()
+
+if __name__ == "__main__":
+    start_timef = time()
+    run_dot()
+    end_timef = time()
+    print('total dot time:', end_timef-start_timef)
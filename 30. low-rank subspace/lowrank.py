@@ -0,0 +1,60 @@
+"""Low-rank compression of the bands of a patch of neighboring k-points.
+
+On a fine k-grid the bands of nearby k-points span almost the same subspace.
+All the (nk, band) wavefunctions of a patch of the k-grid are stacked in a
+matrix X and a shared orthonormal real-space basis V (rank, nr) is taken from
+its truncated SVD (through the eigenvectors of the small Gram matrix X X^H).
+Each k-point keeps only its coefficients C = Psi V^H (nbnd, rank); the residual
+Psi - C V can be kept as well (lossless up to round-off) or only its norm.
+
+In the reduced basis the overlap between k-points of patches p and q is
+    Psi_k diag(dphase) Psi_k'^H  ~  C_k (V_p diag(dphase) V_q^H) C_k'^H
+and the (rank_p, rank_q) middle matrix is shared by every edge between the two
+patches along the same direction.
+"""
+
+from typing import Dict, Tuple
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+except:
+    pass
+
+
+def build_basis(x: np.ndarray, tol: float) -> np.ndarray:
+    """Orthonormal basis (rank, nr) for the rows of x (n, nr).
+
+    The rank is the smallest one for which the discarded singular values hold
+    less than tol^2 of the total weight of x.
+    """
+    eigenvalues, u = np.linalg.eigh(x @ x.conj().T)
+    eigenvalues, u = eigenvalues[::-1].clip(min=0), u[:, ::-1]
+    discarded = 1 - np.cumsum(eigenvalues) / np.sum(eigenvalues)
+    rank = int(np.searchsorted(-discarded, -tol ** 2)) + 1
+    rank = min(rank, int(np.sum(eigenvalues > 1e-14 * eigenvalues[0])))
+    return (u[:, :rank].conj().T @ x) / np.sqrt(eigenvalues[:rank])[:, None]
+
+
+def compress_patch(psi: Dict[int, np.ndarray], tol: float) -> Tuple[np.ndarray, Dict[int, np.ndarray], Dict[int, np.ndarray]]:
+    """Basis, coefficients and residuals of the k-points of one patch."""
+    basis = build_basis(np.concatenate(list(psi.values())), tol)
+    coef = {nk: block @ basis.conj().T for nk, block in psi.items()}
+    residual = {nk: block - coef[nk] @ basis for nk, block in psi.items()}
+    return basis, coef, residual
+
+
+def middle_matrix(basis0: np.ndarray, basis1: np.ndarray, dphase: np.ndarray) -> np.ndarray:
+    """V_p diag(dphase) V_q^H, the overlap kernel of the reduced basis."""
+    return (basis0 * dphase) @ basis1.conj().T
+
+
+def error_bound(resnorm0: np.ndarray, resnorm1: np.ndarray) -> np.ndarray:
+    """Bound for |dpc - dpc reduced| (not normalized) for all pairs of bands.
+
+    With |dphase| = 1 and |Psi|^2 = nr the dropped terms are bounded by
+    |r0| |Psi1| + |Psi0| |r1| + |r0| |r1|.
+    """
+    norm = np.sqrt(m.nr)
+    return (resnorm0[:, None] * norm + norm * resnorm1[None, :] + resnorm0[:, None] * resnorm1[None, :])
@@ -0,0 +1,136 @@
+from multiprocessing import Pool, Array
+from typing import List, Tuple
+import os
+from time import time
+import ctypes
+import logging
+
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.loadmeta as m
+except:
+    pass
+
+
+def load_block(nk: int) -> np.ndarray:
+    """All the bands of k-point nk as one (nbnd, nr) block, (nbnd, 2 * nr) with both spinor components."""
+    if m.noncolin:  # Noncolinear case
+        return np.array([
+            np.concatenate((np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-0.wfc")),
+                            np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-1.wfc"))))
+            for band in range(m.nbnd)
+        ])
+
+    # Non-relativistic case
+    wfc = np.load(os.path.join(m.wfcdirectory, "wfc.npy"), mmap_mode="r")
+    size = m.nbnd * m.nr
+    return np.array(wfc[nk * size : (nk + 1) * size]).reshape(m.nbnd, m.nr)
+
+
+def dot(nk: int, edges: List[Tuple[int, int, int]]) -> None:
+    """Overlaps of k-point nk with all its forward neighbors in one matrix product.
+
+    The neighbor blocks, times the conjugate of the phase difference, are stacked
+    in a (len(edges) * nbnd, nr) matrix so that
+        Psi_nk @ B^H = [Psi_nk diag(dphase_j) Psi_j^H for j in edges]
+    """
+    start = time()
+
+    js, neighbors, jNeighbors = (np.array(x) for x in zip(*edges))
+    dphase = d_phase[:, [nk]] * d_phase[:, neighbors].conj()        # (nr, len(edges))
+    if m.noncolin:
+        dphase = np.concatenate((dphase, dphase))
+
+    wfcnk = load_block(nk)
+    stacked = np.concatenate([load_block(neighbor) * dphase[:, i].conj() for i, neighbor in enumerate(neighbors)])
+
+    # not normalized dot product, (nbnd, len(edges) * nbnd) -> (len(edges), nbnd, nbnd)
+    overlaps = (wfcnk @ stacked.conj().T).reshape(m.nbnd, len(edges), m.nbnd).transpose(1, 0, 2)
+    dpc[nk, js] = overlaps
+    dpc[neighbors, jNeighbors] = overlaps.conj().transpose(0, 2, 1)
+
+    logger.debug(f"\tFinished of nk: {nk:>4}\tneighbors: {neighbors}\tin: {(time() - start):>4.2f} seconds")
+
+
+def get_point_neighbors(nk: int) -> Tuple[int, List[Tuple[int, int, int]]]:
+    """Generates the arguments for the dot function: the forward neighbors of nk."""
+    edges = []
+    for j in range(2 * m.dimensions):
+        neighbor = d.neighbors[nk, j]
+        if neighbor != -1 and neighbor > nk:
+            jNeighbor = np.where(d.neighbors[neighbor] == nk)[0][0]
+            edges.append((j, neighbor, jNeighbor))
+    if edges:
+        return (nk, edges)
+    return None
+
+def run_dot(npr: int = 1, logger_name: str = "dot", logger_level: logging = logging.INFO, flush: bool = False):
+    global dpc, logger, d_phase
+    logger = log(logger_name, "DOT PRODUCT", level=logger_level, flush=flush)
+
+    if not 0 < npr <= os.cpu_count():
+        raise ValueError(f"npr must be between 1 and {os.cpu_count()}")
+
+    logger.header()
+
+    ###########################################################################
+    # 1. DEFINING THE CONSTANTS
+    ###########################################################################
+    DPC_SIZE = m.nks * 2 * m.dimensions * m.nbnd * m.nbnd
+    DPC_SHAPE = (m.nks, 2 * m.dimensions, m.nbnd, m.nbnd)
+
+    ###########################################################################
+    # 2. STDOUT THE PARAMETERS
+    ###########################################################################
+    logger.info(f"\tUnique reference of run: {m.refname}")
+    logger.info(f"\tNumber of processors to use: {npr}")
+    logger.info(f"\tNumber of bands: {m.nbnd}")
+    logger.info(f"\tTotal number of k-points: {m.nks}")
+    logger.info(f"\tTotal number of points in real space: {m.nr}")
+    logger.info(f"\tDirectory where the wfc are: {m.wfcdirectory}\n")
+
+    ###########################################################################
+    # 3. CREATE ALL THE ARRAYS
+    ###########################################################################
+    dpc_base = Array(ctypes.c_double, 2 * DPC_SIZE, lock=False)
+    dpc = np.frombuffer(dpc_base, dtype=np.complex128).reshape(DPC_SHAPE)
+    dp = np.zeros(DPC_SHAPE, dtype=np.float64)
+    d_phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")))
+
+    ###########################################################################
+    # 4. CALCULATE
+    ###########################################################################
+    with Pool(npr) as pool:
+        pre_connection_args = (
+            args
+            for nk in range(m.nks)
+            if (args := get_point_neighbors(nk)) is not None
+        )
+
+        pool.starmap(dot, pre_connection_args)
+
+    dpc /= m.nr         # To normalize the dot product
+    dp = np.abs(dpc)    # Calculate the modulus of the dot product
+
+    ###########################################################################
+    # 5. SAVE OUTPUT
+    ###########################################################################
+    np.save(os.path.join(m.data_dir, "dpc.npy"), dpc)
+    np.save(os.path.join(m.data_dir, "dp.npy"), dp)
+    logger.info(f"\n\tDot products saved to file dpc.npy")
+    logger.info(f"\tDot products modulus saved to file dp.npy")
+
+    ###########################################################################
+    # Finished
+    ###########################################################################
+    logger.footer()
+
+if __name__ == "__main__":
+    start_timef = time()
+    run_dot()
+    end_timef = time()
+    print('total dot time:', end_timef-start_timef)
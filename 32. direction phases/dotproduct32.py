@@ -0,0 +1,175 @@
+from multiprocessing import Pool, Array
+from typing import List, Tuple
+import os
+from time import time
+import ctypes
+import logging
+
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.loadmeta as m
+except:
+    pass
+
+
+def load_block(nk: int) -> np.ndarray:
+    """All the bands of k-point nk as one (nbnd, nr) block, (nbnd, 2 * nr) with both spinor components."""
+    if m.noncolin:  # Noncolinear case
+        return np.array([
+            np.concatenate((np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-0.wfc")),
+                            np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-1.wfc"))))
+            for band in range(m.nbnd)
+        ])
+
+    # Non-relativistic case
+    wfc = np.load(os.path.join(m.wfcdirectory, "wfc.npy"), mmap_mode="r")
+    size = m.nbnd * m.nr
+    return np.array(wfc[nk * size : (nk + 1) * size]).reshape(m.nbnd, m.nr)
+
+
+def phase_groups(edges: List[Tuple[int, int, int, int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups the edges by the step between the two k-points on the grid.
+
+    On a regular grid the phase difference exp(i r.(k - k')) only depends on
+    k - k', i.e. on the direction j (and on the wrap, for neighbors across the
+    border of the grid).  Returns the group of every edge and one
+    representative edge (nk, neighbor) per group.
+    """
+    steps = np.array([d.nktoijl[neighbor] - d.nktoijl[nk] for nk, _, neighbor, _ in edges])
+    _, first, group = np.unique(steps, axis=0, return_index=True, return_inverse=True)
+    representatives = np.array([(edges[i][0], edges[i][2]) for i in first])
+    return group.reshape(-1), representatives
+
+
+def direction_phases(representatives: np.ndarray, edges: List[Tuple[int, int, int, int]],
+                     group: np.ndarray, stride: int = 97) -> np.ndarray:
+    """conj(dphase) of every group, (nr, ngroups) (twice as long with spinors).
+
+    Every edge is checked against the phase of its group on one point out of
+    `stride`, so a grid that is not regular is caught here.
+    """
+    phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")), mmap_mode="r")
+    nks, neighbors = representatives.T
+    dphase = (np.array(phase[:, nks]) * np.array(phase[:, neighbors]).conj()).conj()
+
+    sample = np.array(phase[::stride])
+    for (nk, _, neighbor, _), g in zip(edges, group):
+        error = np.max(np.abs((sample[:, nk] * sample[:, neighbor].conj()).conj() - dphase[::stride, g]))
+        if error > 1e-8:
+            raise ValueError(f"The phase of the edge ({nk}, {neighbor}) differs from its direction by {error:.2e}, the k-grid is not regular")
+
+    if m.noncolin:
+        dphase = np.concatenate((dphase, dphase))
+    return dphase
+
+
+def dot(nk: int, edges: List[Tuple[int, int, int, int]]) -> None:
+    """Overlaps of k-point nk with all its forward neighbors in one matrix product.
+
+    The neighbor blocks, times the conjugate of the phase difference of their
+    direction, are stacked in a (len(edges) * nbnd, nr) matrix so that
+        Psi_nk @ B^H = [Psi_nk diag(dphase_j) Psi_j^H for j in edges]
+    """
+    start = time()
+
+    js, neighbors, jNeighbors, groups = (np.array(x) for x in zip(*edges))
+
+    wfcnk = load_block(nk)
+    stacked = np.concatenate([load_block(neighbor) * dphase_conj[:, g] for neighbor, g in zip(neighbors, groups)])
+
+    # not normalized dot product, (nbnd, len(edges) * nbnd) -> (len(edges), nbnd, nbnd)
+    overlaps = (wfcnk @ stacked.conj().T).reshape(m.nbnd, len(edges), m.nbnd).transpose(1, 0, 2)
+    dpc[nk, js] = overlaps
+    dpc[neighbors, jNeighbors] = overlaps.conj().transpose(0, 2, 1)
+
+    logger.debug(f"\tFinished of nk: {nk:>4}\tneighbors: {neighbors}\tin: {(time() - start):>4.2f} seconds")
+
+
+def get_point_neighbors(nk: int, j: int) -> None:
+    """Generates the arguments for the pre_connection function."""
+    neighbor = d.neighbors[nk, j]
+    if neighbor != -1 and neighbor > nk:
+        jNeighbor = np.where(d.neighbors[neighbor] == nk)[0][0]
+
+        return (nk, j, neighbor, jNeighbor)
+    return None
+
+def run_dot(npr: int = 1, logger_name: str = "dot", logger_level: logging = logging.INFO, flush: bool = False):
+    global dpc, logger, dphase_conj
+    logger = log(logger_name, "DOT PRODUCT", level=logger_level, flush=flush)
+
+    if not 0 < npr <= os.cpu_count():
+        raise ValueError(f"npr must be between 1 and {os.cpu_count()}")
+
+    logger.header()
+
+    ###########################################################################
+    # 1. DEFINING THE CONSTANTS
+    ###########################################################################
+    DPC_SIZE = m.nks * 2 * m.dimensions * m.nbnd * m.nbnd
+    DPC_SHAPE = (m.nks, 2 * m.dimensions, m.nbnd, m.nbnd)
+
+    ###########################################################################
+    # 2. STDOUT THE PARAMETERS
+    ###########################################################################
+    logger.info(f"\tUnique reference of run: {m.refname}")
+    logger.info(f"\tNumber of processors to use: {npr}")
+    logger.info(f"\tNumber of bands: {m.nbnd}")
+    logger.info(f"\tTotal number of k-points: {m.nks}")
+    logger.info(f"\tTotal number of points in real space: {m.nr}")
+    logger.info(f"\tDirectory where the wfc are: {m.wfcdirectory}\n")
+
+    ###########################################################################
+    # 3. CREATE ALL THE ARRAYS
+    ###########################################################################
+    dpc_base = Array(ctypes.c_double, 2 * DPC_SIZE, lock=False)
+    dpc = np.frombuffer(dpc_base, dtype=np.complex128).reshape(DPC_SHAPE)
+    dp = np.zeros(DPC_SHAPE, dtype=np.float64)
+
+    # The phase differences, one per direction, are computed once here and
+    # shared (read-only, inherited by the forked workers) instead of phase.npy
+    edges = [
+        args
+        for nk in range(m.nks)
+        for j in range(2 * m.dimensions)
+        if (args := get_point_neighbors(nk, j)) is not None
+    ]
+    group, representatives = phase_groups(edges)
+    dphase_conj = direction_phases(representatives, edges, group)
+    logger.info(f"\tPhase differences: {len(representatives)} for {len(edges)} edges")
+
+    ###########################################################################
+    # 4. CALCULATE
+    ###########################################################################
+    pre_connection_args = {}
+    for (nk, j, neighbor, jNeighbor), g in zip(edges, group):
+        pre_connection_args.setdefault(nk, []).append((j, neighbor, jNeighbor, g))
+
+    with Pool(npr) as pool:
+        pool.starmap(dot, pre_connection_args.items())
+
+    dpc /= m.nr         # To normalize the dot product
+    dp = np.abs(dpc)    # Calculate the modulus of the dot product
+
+    ###########################################################################
+    # 5. SAVE OUTPUT
+    ###########################################################################
+    np.save(os.path.join(m.data_dir, "dpc.npy"), dpc)
+    np.save(os.path.join(m.data_dir, "dp.npy"), dp)
+    logger.info(f"\n\tDot products saved to file dpc.npy")
+    logger.info(f"\tDot products modulus saved to file dp.npy")
+
+    ###########################################################################
+    # Finished
+    ###########################################################################
+    logger.footer()
+
+if __name__ == "__main__":
+    start_timef = time()
+    run_dot()
+    end_timef = time()
+    print('total dot time:', end_timef-start_timef)
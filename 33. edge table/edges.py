@@ -0,0 +1,71 @@
+"""Table of the forward edges (nk, j, neighbor, jNeighbor) of the k-grid.
+
+Every pair of neighboring k-points appears once, from the smaller index
+(nk < neighbor), with the direction j from nk and the direction jNeighbor from
+the neighbor back to nk.  The rows are sorted by nk.  Also the square patches
+of the k-grid used to hand neighboring k-points to the same task.
+"""
+
+from typing import List, Tuple
+import os
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.loaddata as d
+except:
+    pass
+
+EDGES_FILE = "edges.npy"
+
+
+def build(neighbors: np.ndarray) -> np.ndarray:
+    """Forward edges of the neighbors table (nks, 2 * dimensions), as an (nedges, 4) array."""
+    nks = np.arange(neighbors.shape[0])
+    nk, j = np.nonzero((neighbors != -1) & (neighbors > nks[:, None]))
+    neighbor = neighbors[nk, j]
+    back = neighbors[neighbor] == nk[:, None]
+    if not np.all(back.any(axis=1)):
+        i = np.flatnonzero(~back.any(axis=1))[0]
+        raise ValueError(f"The neighbors table is not symmetric: {nk[i]} has neighbor {neighbor[i]} but not the other way around")
+    jNeighbor = np.argmax(back, axis=1)
+    return np.stack((nk, j, neighbor, jNeighbor), axis=1).astype(np.int64)
+
+
+def load() -> np.ndarray:
+    """Edge table of the run, cached in m.data_dir next to neighbors.npy.
+
+    The cache is rebuilt when neighbors.npy is newer than it or when it does
+    not match the current number of k-points and directions.
+    """
+    cache = os.path.join(m.data_dir, EDGES_FILE)
+    source = os.path.join(m.data_dir, "neighbors.npy")
+    if os.path.exists(cache) and (not os.path.exists(source) or os.path.getmtime(cache) >= os.path.getmtime(source)):
+        table = np.load(cache)
+        if table.size == 0 or (table[:, 0].max() < m.nks and table[:, 1].max() < 2 * m.dimensions):
+            return table
+
+    table = build(d.neighbors)
+    np.save(cache, table)
+    return table
+
+
+def chunks(table: np.ndarray, nchunks: int) -> List[Tuple[int, int]]:
+    """Splits the rows of the table in about nchunks contiguous (start, end) ranges.
+
+    The ranges hold whole k-points, so all the edges of one nk go to the same task.
+    """
+    if len(table) == 0:
+        return []
+    starts = np.flatnonzero(np.diff(table[:, 0], prepend=-1))
+    groups = np.array_split(np.arange(len(starts)), min(nchunks, len(starts)))
+    bounds = np.append(starts, len(table))
+    return [(int(bounds[g[0]]), int(bounds[g[-1] + 1])) for g in groups if len(g)]
+
+
+def patches(size: int) -> np.ndarray:
+    """Patch of every k-point, for square patches of size x size (x size) k-points."""
+    ijl = d.nktoijl // size
+    shape = np.max(ijl, axis=0) + 1
+    return np.ravel_multi_index(ijl.T, shape)
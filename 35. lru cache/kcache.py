@@ -0,0 +1,55 @@
+"""Least recently used cache of k-point blocks, with a budget in bytes.
+
+Each worker keeps its own cache; the blocks are the (nbnd, nr) phase-fixed
+wavefunctions of one k-point as returned by `loader`.  The k-points are handed
+to the workers in the patches of edges.patches.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Tuple
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+except:
+    pass
+
+
+class KBlockCache:
+    def __init__(self, budget: int, loader: Callable[[int], np.ndarray]):
+        self.budget = budget
+        self.loader = loader
+        self.blocks = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+
+    def __getitem__(self, nk: int) -> np.ndarray:
+        if nk in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(nk)
+            return self.blocks[nk]
+
+        block = self.loader(nk)
+        self.misses += 1
+        self.bytes_read += block.nbytes
+
+        # the newest block is always kept, even when it alone is over the budget
+        self.blocks[nk] = block
+        self.size += block.nbytes
+        while self.size > self.budget and len(self.blocks) > 1:
+            _, old = self.blocks.popitem(last=False)
+            self.size -= old.nbytes
+        return block
+
+    def stats(self) -> Tuple[int, int, int]:
+        return self.hits, self.misses, self.bytes_read
+
+
+def patch_size(budget: int, block_bytes: int) -> int:
+    """Side of the k-grid patches whose blocks (plus one layer of neighbors) fit in the budget."""
+    capacity = max(1, budget // block_bytes)
+    return max(1, int(capacity ** (1 / m.dimensions)) - 1)
+
@@ -0,0 +1,118 @@
+"""Orderings of the k-points along space filling curves of the k-grid.
+
+With the k-points stored (and visited) in Morton or Hilbert order, neighbors
+along every direction of the grid tend to be close in the file and in time,
+instead of nkx k-points apart along the second direction.  The curves are
+taken over the grid coordinates d.nktoijl of the directions actually used.
+
+The order is saved in korder.npz next to wfc.npy, together with the size and
+modification time of the wfc.npy it was written with, so an order left over
+from another run is refused instead of mapping k-points to the wrong slots.
+"""
+
+import os
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.loaddata as d
+except:
+    pass
+
+CURVES = ("linear", "morton", "hilbert")
+ORDER_FILE = "korder.npz"
+
+
+def _interleave(x: np.ndarray, bits: int) -> np.ndarray:
+    """Index made of the bits of the coordinates, most significant first."""
+    index = np.zeros(len(x), dtype=np.int64)
+    for b in range(bits - 1, -1, -1):
+        for i in range(x.shape[1]):
+            index = (index << 1) | ((x[:, i] >> b) & 1)
+    return index
+
+
+def morton(x: np.ndarray, bits: int) -> np.ndarray:
+    """Morton (Z-order) index of the integer coordinates x (npoints, ndims)."""
+    return _interleave(x, bits)
+
+
+def hilbert(x: np.ndarray, bits: int) -> np.ndarray:
+    """Hilbert index of the integer coordinates x (npoints, ndims).
+
+    J. Skilling, "Programming the Hilbert curve", AIP Conf. Proc. 707 (2004):
+    the coordinates are transformed in place and the bits interleaved.
+    """
+    x = np.array(x, dtype=np.int64)
+    n = x.shape[1]
+
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = q - 1
+        for i in range(n):
+            high = (x[:, i] & q) != 0
+            x[high, 0] ^= p                                 # invert
+            t = (x[~high, 0] ^ x[~high, i]) & p             # exchange
+            x[~high, 0] ^= t
+            x[~high, i] ^= t
+        q >>= 1
+
+    # Gray encode
+    for i in range(1, n):
+        x[:, i] ^= x[:, i - 1]
+    t = np.zeros(len(x), dtype=np.int64)
+    q = 1 << (bits - 1)
+    while q > 1:
+        t = np.where(x[:, n - 1] & q, t ^ (q - 1), t)
+        q >>= 1
+    x ^= t[:, None]
+
+    return _interleave(x, bits)
+
+
+def order(curve: str = "hilbert") -> np.ndarray:
+    """k-points in the order of the curve; order[slot] = nk."""
+    if curve not in CURVES:
+        raise ValueError(f"curve must be one of {CURVES}")
+    if curve == "linear":
+        return np.arange(m.nks)
+
+    ijl = d.nktoijl[:, np.max(d.nktoijl, axis=0) > 0]
+    if ijl.shape[1] == 0:
+        return np.arange(m.nks)
+    bits = max(1, int(np.max(ijl)).bit_length())
+    index = morton(ijl, bits) if curve == "morton" else hilbert(ijl, bits)
+    return np.argsort(index, kind="stable")
+
+
+def slots(korder: np.ndarray) -> np.ndarray:
+    """Inverse of the order: slot of every k-point in the storage."""
+    slot = np.empty_like(korder)
+    slot[korder] = np.arange(len(korder))
+    return slot
+
+
+def _stamp(store: str) -> np.ndarray:
+    stat = os.stat(store)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def save_order(directory: str, korder: np.ndarray):
+    """Records korder for the wfc.npy already written in directory."""
+    np.savez(os.path.join(directory, ORDER_FILE), korder=korder, stamp=_stamp(os.path.join(directory, "wfc.npy")))
+
+
+def load_order(directory: str) -> np.ndarray:
+    """Order of the k-points in the wfc.npy of directory (linear if no order was recorded)."""
+    order_file = os.path.join(directory, ORDER_FILE)
+    if not os.path.exists(order_file):
+        return np.arange(m.nks)
+
+    with np.load(order_file) as saved:
+        korder, stamp = saved["korder"], saved["stamp"]
+    if not np.array_equal(stamp, _stamp(os.path.join(directory, "wfc.npy"))):
+        raise ValueError(f"{order_file} was written for another wfc.npy, remove it or generate the wavefunctions again")
+    if len(korder) != m.nks:
+        raise ValueError(f"{order_file} has {len(korder)} k-points, expected {m.nks}")
+    return korder
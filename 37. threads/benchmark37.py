@@ -0,0 +1,33 @@
+import argparse
+import logging
+import time
+
+from dotproduct37 import run_dot, BACKENDS
+
+# Run in the directory of a prepared berry run (e.g. Inputs/input1 or Inputs/input2),
+# after generatewfc, so that the dot product reads the real wfc.npy of that size.
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--npr", type=int, nargs="+", default=[1, 2, 4], help="Numbers of workers to try")
+    ap.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS, help="Backends to compare")
+    ap.add_argument("--blas-threads", type=int, default=0, help="BLAS threads per worker (0: cores / npr)")
+    ap.add_argument("--repeat", type=int, default=3, help="Runs per configuration (the best is kept)")
+    args = ap.parse_args()
+
+    results = {}
+    for npr in args.npr:
+        for backend in args.backends:
+            times = []
+            for _ in range(args.repeat):
+                start = time.time()
+                run_dot(npr, backend=backend, blas_threads=args.blas_threads, logger_level=logging.WARNING)
+                times.append(time.time() - start)
+            results[(backend, npr)] = min(times)
+            print(f"{backend:8s} | npr: {npr:3d} | best: {min(times):8.3f} s | mean: {sum(times) / len(times):8.3f} s")
+
+    backend, npr = min(results, key=results.get)
+    print(f"Fastest: run_dot({npr}, backend=\"{backend}\") in {results[(backend, npr)]:.3f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+from multiprocessing import Pool, Array
+from typing import Tuple
+import os
+from time import time
+import ctypes
+import logging
+
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.edges as e
+except:
+    pass
+
+# Type of the tiles and of their products; the sums over tiles are always complex128
+PRECISIONS = {"double": np.complex128, "mixed": np.complex64}
+
+
+def open_store(nk: int):
+    """Memory-mapped (nbnd, nr) bands of k-point nk, one per spinor component; nothing is read yet."""
+    if m.noncolin:  # Noncolinear case
+        return [
+            [np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-{s}.wfc"), mmap_mode="r") for band in range(m.nbnd)]
+            for s in range(2)
+        ]
+
+    # Non-relativistic case
+    wfc = np.load(os.path.join(m.wfcdirectory, "wfc.npy"), mmap_mode="r")
+    return [wfc.reshape(m.nks, m.nbnd, m.nr)[nk]]
+
+
+def store_dtype() -> np.dtype:
+    """Type of the values as they are read from the store."""
+    return open_store(0)[0][0].dtype
+
+
+def load_tile(store, start: int, end: int, dtype: np.dtype) -> np.ndarray:
+    """Points start:end of all the bands, (nbnd, end - start) ((nbnd, 2 * (end - start)) with spinors).
+
+    Every band is cast to dtype as it is read, so no full tile is held in the type of the store.
+    """
+    size = end - start
+    tile = np.empty((m.nbnd, len(store) * size), dtype=dtype)
+    for s, component in enumerate(store):
+        for i, band in enumerate(component):
+            tile[i, s * size : (s + 1) * size] = band[start:end]
+    return tile
+
+
+def phase_groups(table: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups the edges by the step between the two k-points on the grid.
+
+    On a regular grid the phase difference exp(i r.(k - k')) only depends on
+    k - k', i.e. on the direction j (and on the wrap, for neighbors across the
+    border of the grid).  Returns the group of every edge and one
+    representative edge (nk, neighbor) per group.
+    """
+    steps = d.nktoijl[table[:, 2]] - d.nktoijl[table[:, 0]]
+    _, first, group = np.unique(steps, axis=0, return_index=True, return_inverse=True)
+    return group.reshape(-1), table[first][:, [0, 2]]
+
+
+def direction_phases(representatives: np.ndarray, table: np.ndarray, group: np.ndarray, stride: int = 97) -> np.ndarray:
+    """conj(dphase) of every group, (nr, ngroups).
+
+    Every edge is checked against the phase of its group on one point out of
+    `stride`, so a grid that is not regular is caught here.
+    """
+    phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")), mmap_mode="r")
+    nks, neighbors = representatives.T
+    dphase = (np.array(phase[:, nks]) * np.array(phase[:, neighbors]).conj()).conj()
+
+    sample = phase[::stride]        # a view of the memmap, only the columns of each chunk are read
+    for first in range(0, len(table), 64):     # 64 edges at a time, to bound the temporaries
+        rows = table[first : first + 64]
+        error = np.max(np.abs((sample[:, rows[:, 0]] * sample[:, rows[:, 2]].conj()).conj() - dphase[::stride, group[first : first + 64]]), axis=0)
+        if np.any(error > 1e-8):
+            nk, _, neighbor, _ = rows[np.argmax(error)]
+            raise ValueError(f"The phase of the edge ({nk}, {neighbor}) differs from its direction by {error.max():.2e}, the k-grid is not regular")
+
+    return dphase
+
+
+def overlaps_kpoint(nk: int, neighbors: np.ndarray, groups: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Overlaps of k-point nk with all its forward neighbors, accumulated over tiles of r.
+
+    For every tile the neighbor blocks, times the conjugate of the phase
+    difference of their direction, are stacked in a (len(edges) * nbnd, tile)
+    matrix so that
+        Psi_nk @ B^H = [Psi_nk diag(dphase_j) Psi_j^H for j in edges]
+    The tiles are cast to dtype (complex64 in the mixed precision mode) and
+    their products are summed in complex128.  Returns (len(edges), nbnd, nbnd).
+    """
+    storenk = open_store(nk)
+    stores = [open_store(neighbor) for neighbor in neighbors]
+
+    products = np.zeros((m.nbnd, len(neighbors) * m.nbnd), dtype=np.complex128)
+    for start in range(0, m.nr, tile):
+        end = min(start + tile, m.nr)
+        dphase = dphase_conj[start:end].astype(dtype, copy=False)
+        if m.noncolin:
+            dphase = np.concatenate((dphase, dphase))
+
+        wfcnk = load_tile(storenk, start, end, dtype)
+        stacked = np.concatenate([load_tile(store, start, end, dtype) * dphase[:, g]
+                                  for store, g in zip(stores, groups)])
+        products += wfcnk @ stacked.conj().T
+
+    # not normalized dot product, (nbnd, len(edges) * nbnd) -> (len(edges), nbnd, nbnd)
+    return products.reshape(m.nbnd, len(neighbors), m.nbnd).transpose(1, 0, 2)
+
+
+def dot_kpoint(nk: int, js: np.ndarray, neighbors: np.ndarray, jNeighbors: np.ndarray, groups: np.ndarray) -> None:
+    overlaps = overlaps_kpoint(nk, neighbors, groups, dtype)
+    dpc[nk, js] = overlaps
+    dpc[neighbors, jNeighbors] = overlaps.conj().transpose(0, 2, 1)
+
+
+def validate(nvalidate: int) -> Tuple[int, float, float, float]:
+    """Recomputes nvalidate k-points (spread over the grid) in full precision.
+
+    Returns the number of edges checked and the largest absolute error of the
+    normalized dpc, the largest error relative to max |dpc| of the same k-point
+    (near zero overlaps would blow up an elementwise ratio) and the largest error of dp.
+    """
+    kpoints = np.unique(table[:, 0])
+    kpoints = kpoints[np.linspace(0, len(kpoints) - 1, min(nvalidate, len(kpoints))).astype(int)]
+
+    errors, relative, modulus, nedges = 0.0, 0.0, 0.0, 0
+    for nk in np.unique(kpoints):
+        rows = np.flatnonzero(table[:, 0] == nk)
+        exact = overlaps_kpoint(nk, table[rows, 2], group[rows], np.complex128) / m.nr
+        difference = np.abs(dpc[nk, table[rows, 1]] - exact)
+        errors = max(errors, difference.max())
+        relative = max(relative, difference.max() / max(np.abs(exact).max(), 1e-300))
+        modulus = max(modulus, np.abs(np.abs(dpc[nk, table[rows, 1]]) - np.abs(exact)).max())
+        nedges += len(rows)
+    return nedges, errors, relative, modulus
+
+
+def dot(start: int, end: int) -> None:
+    """Overlaps of the rows start:end of the edge table, one k-point after the other."""
+    begin = time()
+
+    rows = table[start:end]
+    bounds = np.flatnonzero(np.diff(rows[:, 0], append=-1)) + 1
+    for first, last in zip(np.append(0, bounds[:-1]), bounds):
+        nk, js, neighbors, jNeighbors = rows[first, 0], rows[first:last, 1], rows[first:last, 2], rows[first:last, 3]
+        dot_kpoint(nk, js, neighbors, jNeighbors, group[start + first : start + last])
+
+    logger.debug(f"\tFinished k-points: {table[start, 0]:>4} to {table[end - 1, 0]:>4}\tin: {(time() - begin):>4.2f} seconds")
+
+def run_dot(npr: int = 1, tile_mb: int = 64, precision: str = "double", nvalidate: int = 4, logger_name: str = "dot", logger_level: logging = logging.INFO, flush: bool = False):
+    global dpc, logger, dphase_conj, table, group, tile, dtype
+    logger = log(logger_name, "DOT PRODUCT", level=logger_level, flush=flush)
+
+    if not 0 < npr <= os.cpu_count():
+        raise ValueError(f"npr must be between 1 and {os.cpu_count()}")
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {tuple(PRECISIONS)}")
+
+    logger.header()
+
+    ###########################################################################
+    # 1. DEFINING THE CONSTANTS
+    ###########################################################################
+    DPC_SIZE = m.nks * 2 * m.dimensions * m.nbnd * m.nbnd
+    DPC_SHAPE = (m.nks, 2 * m.dimensions, m.nbnd, m.nbnd)
+    # Points of r per tile, for one k-point and up to 2 * dimensions neighbors in tile_mb,
+    # with the larger of the type read from the store and the type of the products
+    ITEMSIZE = max(store_dtype().itemsize, np.dtype(PRECISIONS[precision]).itemsize)
+    POINT_SIZE = (2 if m.noncolin else 1) * m.nbnd * (1 + 2 * m.dimensions) * ITEMSIZE
+    TILE = int(min(m.nr, max(1, tile_mb * 1024 ** 2 // POINT_SIZE)))
+
+    ###########################################################################
+    # 2. STDOUT THE PARAMETERS
+    ###########################################################################
+    logger.info(f"\tUnique reference of run: {m.refname}")
+    logger.info(f"\tNumber of processors to use: {npr}")
+    logger.info(f"\tNumber of bands: {m.nbnd}")
+    logger.info(f"\tTotal number of k-points: {m.nks}")
+    logger.info(f"\tTotal number of points in real space: {m.nr}")
+    logger.info(f"\tDirectory where the wfc are: {m.wfcdirectory}")
+    logger.info(f"\tPrecision of the tiles: {precision} ({np.dtype(PRECISIONS[precision]).name}, sums in complex128)")
+    logger.info(f"\tType of the values in the store: {store_dtype().name}")
+    logger.info(f"\tPoints of r per tile: {TILE} ({-(-m.nr // TILE)} tiles, about {tile_mb} MiB per processor)\n")
+
+    ###########################################################################
+    # 3. CREATE ALL THE ARRAYS
+    ###########################################################################
+    dpc_base = Array(ctypes.c_double, 2 * DPC_SIZE, lock=False)
+    dpc = np.frombuffer(dpc_base, dtype=np.complex128).reshape(DPC_SHAPE)
+    dp = np.zeros(DPC_SHAPE, dtype=np.float64)
+
+    tile = TILE
+    dtype = PRECISIONS[precision]
+    table = e.load()        # Forward edges (nk, j, neighbor, jNeighbor), sorted by nk
+
+    # The phase differences, one per direction, are computed once here and
+    # shared (read-only, inherited by the forked workers) instead of phase.npy
+    group, representatives = phase_groups(table)
+    dphase_conj = direction_phases(representatives, table, group)
+    logger.info(f"\tPhase differences: {len(representatives)} for {len(table)} edges")
+
+    ###########################################################################
+    # 4. CALCULATE
+    ###########################################################################
+    # A few large contiguous chunks of the edge table per processor
+    with Pool(npr) as pool:
+        pool.starmap(dot, e.chunks(table, 4 * npr))
+
+    dpc /= m.nr         # To normalize the dot product
+    dp = np.abs(dpc)    # Calculate the modulus of the dot product
+
+    if precision != "double" and nvalidate > 0:
+        nedges, errors, relative, modulus = validate(nvalidate)
+        logger.info(f"\n\tValidation against complex128 on {nedges} edges:")
+        logger.info(f"\t\tlargest error of dpc: {errors:.3e}\t(relative: {relative:.3e})")
+        logger.info(f"\t\tlargest error of dp: {modulus:.3e}")
+
+    ###########################################################################
+    # 5. SAVE OUTPUT
+    ###########################################################################
+    np.save(os.path.join(m.data_dir, "dpc.npy"), dpc)
+    np.save(os.path.join(m.data_dir, "dp.npy"), dp)
+    logger.info(f"\n\tDot products saved to file dpc.npy")
+    logger.info(f"\tDot products modulus saved to file dp.npy")
+
+    ###########################################################################
+    # Finished
+    ###########################################################################
+    logger.footer()
+
+if __name__ == "__main__":
+    start_timef = time()
+    run_dot()
+    end_timef = time()
+    print('total dot time:', end_timef-start_timef)
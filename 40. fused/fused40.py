@@ -0,0 +1,223 @@
+from collections import deque
+from typing import Dict, List, Tuple
+import os
+from time import time
+import logging
+
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.edges as e
+    import berry._subroutines.qe_wfc as q
+except:
+    pass
+
+
+def generation_order() -> List[int]:
+    """k-points in breadth-first order over d.neighbors, from k-point 0.
+
+    A k-point is generated right after (or next to) its neighbors, so the
+    k-points that still have overlaps to do are a thin frontier of the grid.
+    """
+    seen = np.zeros(m.nks, dtype=bool)
+    order = []
+    for root in range(m.nks):       # every connected part of the grid
+        if seen[root]:
+            continue
+        seen[root] = True
+        queue = deque([root])
+        while queue:
+            nk = queue.popleft()
+            order.append(nk)
+            for neighbor in d.neighbors[nk]:
+                if neighbor != -1 and not seen[neighbor]:
+                    seen[neighbor] = True
+                    queue.append(int(neighbor))
+    return order
+
+
+def wfck2r(nk_point: int) -> np.ndarray:
+    """Phase-fixed wavefunctions of all the bands of nk_point, (nbnd, npol, nr), as in 27. qe binary."""
+    header, mill, evc = q.read_wfc(q.wfc_file(nk_point), m.nbnd)
+    psi = q.to_rspace(mill, evc, header["gamma_only"], workers=m.npr)
+
+    # Phase of every band at rpoint (first spinor component in the noncolinear case)
+    psi_rpoint = psi[:, 0, int(m.rpoint)]
+    deltaphase = np.arctan2(psi_rpoint.imag, psi_rpoint.real)
+    mod_rpoint = np.absolute(psi_rpoint)
+    for i in range(m.nbnd):
+        logger.debug(f"\t{nk_point:6d}  {i:4d}  {mod_rpoint[i]:12.8f}  {deltaphase[i]:12.8f}   {not mod_rpoint[i] < 1e-5}")
+
+    psi *= np.exp(-1j * deltaphase)[:, np.newaxis, np.newaxis]
+    return psi
+
+
+def phase_groups(table: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups the edges by the step between the two k-points on the grid.
+
+    On a regular grid the phase difference exp(i r.(k - k')) only depends on
+    k - k', i.e. on the direction j (and on the wrap, for neighbors across the
+    border of the grid).  Returns the group of every edge and one
+    representative edge (nk, neighbor) per group.
+    """
+    steps = d.nktoijl[table[:, 2]] - d.nktoijl[table[:, 0]]
+    _, first, group = np.unique(steps, axis=0, return_index=True, return_inverse=True)
+    return group.reshape(-1), table[first][:, [0, 2]]
+
+
+def direction_phases(representatives: np.ndarray, table: np.ndarray, group: np.ndarray, stride: int = 97) -> np.ndarray:
+    """conj(dphase) of every group, (nr, ngroups) (twice as long with spinors).
+
+    Every edge is checked against the phase of its group on one point out of
+    `stride`, so a grid that is not regular is caught here.
+    """
+    phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")), mmap_mode="r")
+    nks, neighbors = representatives.T
+    dphase = (np.array(phase[:, nks]) * np.array(phase[:, neighbors]).conj()).conj()
+
+    sample = phase[::stride]        # a view of the memmap, only the columns of each chunk are read
+    for first in range(0, len(table), 64):     # 64 edges at a time, to bound the temporaries
+        rows = table[first : first + 64]
+        error = np.max(np.abs((sample[:, rows[:, 0]] * sample[:, rows[:, 2]].conj()).conj() - dphase[::stride, group[first : first + 64]]), axis=0)
+        if np.any(error > 1e-8):
+            nk, _, neighbor, _ = rows[np.argmax(error)]
+            raise ValueError(f"The phase of the edge ({nk}, {neighbor}) differs from its direction by {error.max():.2e}, the k-grid is not regular")
+
+    if m.noncolin:
+        dphase = np.concatenate((dphase, dphase))
+    return dphase
+
+
+def save_kpoint(nk: int, psi: np.ndarray, psifinal) -> None:
+    """Persists the k-point as the generators do: in wfc.npy, or one file per band and spinor component."""
+    if psifinal is not None:
+        psifinal[nk * m.nbnd * m.nr : (nk + 1) * m.nbnd * m.nr] = psi[:, 0].ravel()
+        return
+    for i in range(psi.shape[0]):
+        for s in range(psi.shape[1]):
+            with open(os.path.join(m.wfcdirectory, f"k0{nk}b0{i}-{s}.wfc"), "wb") as fich:
+                np.save(fich, psi[i, s])
+
+
+def overlaps_new(new: int, resident: Dict[int, np.ndarray], rows: np.ndarray) -> None:
+    """Overlaps of the new k-point with its resident neighbors, in one matrix product.
+
+    With w = conj(dphase) when new is the first k-point of the edge and
+    w = dphase when it is the second one,
+        Psi_new @ [Psi_other * w]^H
+    gives dpc[new, j] in the first case and dpc[other, j]^H in the second.
+    """
+    others = np.where(table[rows, 0] == new, table[rows, 2], table[rows, 0])
+    weights = [dphase_conj[:, g] if table[row, 0] == new else dphase_conj[:, g].conj() for row, g in zip(rows, group[rows])]
+    stacked = np.concatenate([resident[other] * w for other, w in zip(others, weights)])
+
+    blocks = (resident[new] @ stacked.conj().T).reshape(m.nbnd, len(rows), m.nbnd).transpose(1, 0, 2)
+    for (nk, j, neighbor, jNeighbor), block in zip(table[rows], blocks):
+        dpc[nk, j] = block if nk == new else block.conj().T
+        dpc[neighbor, jNeighbor] = dpc[nk, j].conj().T
+
+
+def run_fused(save_wfc: bool = False, logger_name: str = "fused", logger_level: logging = logging.INFO, flush: bool = False):
+    global dpc, logger, dphase_conj, table, group
+    logger = log(logger_name, "GENERATE AND DOT PRODUCT", level=logger_level, flush=flush)
+
+    logger.header()
+
+    ###########################################################################
+    # 1. DEFINING THE CONSTANTS
+    ###########################################################################
+    DPC_SHAPE = (m.nks, 2 * m.dimensions, m.nbnd, m.nbnd)
+    NPOL = 2 if m.noncolin else 1
+    BLOCK_SIZE = NPOL * m.nbnd * m.nr * np.dtype(np.complex128).itemsize
+
+    ###########################################################################
+    # 2. STDOUT THE PARAMETERS
+    ###########################################################################
+    logger.info(f"\tUnique reference of run: {m.refname}")
+    logger.info(f"\tBinary wavefunctions are read from {os.path.join(m.outdir, m.prefix + '.save')}")
+    logger.info(f"\tThis program will run in {m.npr} threads")
+    logger.info(f"\tNumber of bands: {m.nbnd}")
+    logger.info(f"\tTotal number of k-points: {m.nks}")
+    logger.info(f"\tTotal number of points in real space: {m.nr}")
+    logger.info(f"\tWavefunctions also saved in {m.wfcdirectory}: {save_wfc}\n")
+
+    ###########################################################################
+    # 3. CREATE ALL THE ARRAYS
+    ###########################################################################
+    dpc = np.zeros(DPC_SHAPE, dtype=np.complex128)
+    table = e.load()        # Forward edges (nk, j, neighbor, jNeighbor), sorted by nk
+    group, representatives = phase_groups(table)
+    dphase_conj = direction_phases(representatives, table, group)
+
+    # Edges still to do for every k-point; a k-point leaves memory when it has none
+    pending = np.bincount(table[:, [0, 2]].ravel(), minlength=m.nks)
+    edges_of = [[] for _ in range(m.nks)]
+    for row, (nk, _, neighbor, _) in enumerate(table):
+        edges_of[nk].append(row)
+        edges_of[neighbor].append(row)
+
+    psifinal = None
+    if save_wfc:
+        os.makedirs(m.wfcdirectory, exist_ok=True)
+        if not m.noncolin:
+            psifinal = np.lib.format.open_memmap(os.path.join(m.wfcdirectory, "wfc.npy"), mode="w+",
+                                                 dtype=np.complex128, shape=(m.nks * m.nbnd * m.nr,))
+
+    ###########################################################################
+    # 4. GENERATE AND CALCULATE
+    ###########################################################################
+    resident = {}
+    peak = 0
+    for new in generation_order():
+        start = time()
+        psi = wfck2r(new)
+        if save_wfc:
+            save_kpoint(new, psi, psifinal)
+        resident[new] = psi.reshape(m.nbnd, NPOL * m.nr)
+
+        # Every edge to an already generated k-point can be done now
+        rows = np.array([row for row in edges_of[new] if table[row, 0] in resident and table[row, 2] in resident],
+                        dtype=np.int64)
+        if len(rows):
+            overlaps_new(new, resident, rows)
+            for other in np.where(table[rows, 0] == new, table[rows, 2], table[rows, 0]):
+                pending[other] -= 1
+            pending[new] -= len(rows)
+
+        peak = max(peak, len(resident))
+        for nk in [nk for nk in resident if pending[nk] == 0]:
+            del resident[nk]
+
+        logger.debug(f"\tFinished k-point: {new:>4}\tresident: {len(resident):>4}\tin: {(time() - start):>4.2f} seconds")
+
+    if psifinal is not None:
+        psifinal.flush()
+        del psifinal
+
+    logger.info(f"\tLargest number of k-points in memory: {peak} of {m.nks} ({peak * BLOCK_SIZE / 1024 ** 2:.1f} MiB)")
+
+    dpc /= m.nr         # To normalize the dot product
+    dp = np.abs(dpc)    # Calculate the modulus of the dot product
+
+    ###########################################################################
+    # 5. SAVE OUTPUT
+    ###########################################################################
+    np.save(os.path.join(m.data_dir, "dpc.npy"), dpc)
+    np.save(os.path.join(m.data_dir, "dp.npy"), dp)
+    logger.info(f"\n\tDot products saved to file dpc.npy")
+    logger.info(f"\tDot products modulus saved to file dp.npy")
+
+    ###########################################################################
+    # Finished
+    ###########################################################################
+    logger.footer()
+
+if __name__ == "__main__":
+    start_timef = time()
+    run_fused()
+    end_timef = time()
+    print('total fused time:', end_timef-start_timef)
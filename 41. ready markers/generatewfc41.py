@@ -0,0 +1,162 @@
+from typing import Optional
+import time
+import os
+import logging
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.qe_wfc as q
+    import berry._subroutines.ready as ready
+except:
+    pass
+
+
+class WfcGenerator:
+    def __init__(self,
+                 nk_points: Optional[int] = None ,
+                 bands: Optional[int] = None,
+                 logger_name: str = "genwfc",
+                 logger_level: int = logging.INFO,
+                 flush: bool = False
+                ):
+
+        if bands is not None and nk_points is None:
+            raise ValueError("To generate a wavefunction for a single band, you must specify the k-point.")
+
+        os.system("mkdir -p " + m.wfcdirectory)
+        self.outfile = os.path.join(m.wfcdirectory, "wfc.npy")
+        if nk_points is None:
+            self.nk_points = range(m.nks)
+        elif  bands is None:
+            self.nk_points = nk_points
+            self.bands = range(m.nbnd)
+        else:
+            self.nk_points = nk_points
+            self.bands = bands
+        self.ref_name = m.refname
+        self.logger = log(logger_name, "GENERATE WAVE FUNCTIONS", level=logger_level, flush=flush)
+
+
+    def run(self):
+        # prints header on the log file
+        self.logger.header()
+
+        # Logs the parameters for the run
+        self._log_run_params()
+
+        if m.noncolin:
+            self.logger.info("\tNoncolinear calculation, reading both spinor components")
+        else:
+            self.logger.info("\tNonrelativistic calculation")
+
+        # Set which k-points and bands will use (for debuging)
+        if isinstance(self.nk_points, range):
+            self.logger.info("\n\tWill run for all k-points and bands")
+            self.logger.info(f"\tThere are {m.nks} k-points and {m.nbnd} bands.\n")
+
+            # Every k-point is published (ready/k0{nk}.ready) as soon as it is on disk,
+            # so a run_dot(watch=True) started in parallel can already use it
+            if m.noncolin:
+                token = ready.clear()
+                for nk in self.nk_points:
+                    self._save_bands(nk, 0, self._wfck2r(nk, 0, m.nbnd))
+                    ready.mark_ready(nk, token)
+            else:
+                # All k-points go to a single new file, written in place k-point by k-point.
+                # It replaces wfc.npy before the epoch starts, so a consumer still
+                # mapping the previous wfc.npy keeps its data
+                tmp = self.outfile + ".tmp"
+                psifinal = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.complex128,
+                                                     shape=(m.nks * m.nbnd * m.nr,))
+                with open(tmp, "rb+") as fich:
+                    ready.sync(fich)        # the header, before any k-point
+                os.replace(tmp, self.outfile)
+                ready.fsync_directory(m.wfcdirectory)   # the rename is durable before the epoch
+                token = ready.clear()
+                for nk in self.nk_points:
+                    psifinal[nk * m.nbnd * m.nr : (nk + 1) * m.nbnd * m.nr] = self._wfck2r(nk, 0, m.nbnd)[:, 0].ravel()
+                    psifinal.flush()        # msync, the data is on disk before the marker
+                    ready.mark_ready(nk, token)
+                del psifinal
+            ready.finish(token)
+        else:
+            if isinstance(self.bands, range):
+                self.logger.info(f"\tWill run for k-point {self.nk_points} and all bands")
+                self.logger.info(f"\tThere are {m.nks} k-points and {m.nbnd} bands.\n")
+
+                self.logger.info(f"\tCalculating wfc for k-point {self.nk_points}")
+                self._save_bands(self.nk_points, 0, self._wfck2r(self.nk_points, 0, m.nbnd))
+            else:
+                self.logger.info(f"\tWill run just for k-point {self.nk_points} and band {self.bands}.\n")
+                self._save_bands(self.nk_points, self.bands, self._wfck2r(self.nk_points, self.bands, 1))
+
+        self.logger.footer()
+
+
+    def _log_run_params(self):
+        self.logger.info(f"\tUnique reference of run: {self.ref_name}")
+        self.logger.info(f"\tWavefunctions will be saved in directory {m.wfcdirectory}")
+        self.logger.info(f"\tDFT files are in directory {m.dftdirectory}")
+        self.logger.info(f"\tBinary wavefunctions are read from {os.path.join(m.outdir, m.prefix + '.save')}")
+        self.logger.info(f"\tThis program will run in {m.npr} threads\n")
+
+        self.logger.info(f"\tTotal number of k-points: {m.nks}")
+        self.logger.info(f"\tNumber of r-points in each direction: {m.nr1} {m.nr2} {m.nr3}")
+        self.logger.info(f"\tTotal number of points in real space: {m.nr}")
+        self.logger.info(f"\tNumber of bands: {m.nbnd}\n")
+
+        self.logger.info(f"\tPoint choosen for sincronizing phases:  {m.rpoint}\n")
+
+    def _wfck2r(self, nk_point: int, initial_band: int, number_of_bands: int):
+        self.logger.info(f"\tCalculating wfc for k-point {nk_point}")
+
+        # Plane-wave coefficients straight from the QE save directory
+        header, mill, evc = q.read_wfc(q.wfc_file(nk_point), initial_band + number_of_bands)
+        evc = evc[initial_band:]
+
+        # Batched inverse FFT to the real space grid: psi has shape (bands, npol, nr)
+        psi = q.to_rspace(mill, evc, header["gamma_only"], workers=m.npr)
+
+        # For each band, find the value of the wfc at the specific point rpoint (in real space)
+        # (first spinor component in the noncolinear case)
+        psi_rpoint = psi[:, 0, int(m.rpoint)]
+
+        # Calculate the phase at rpoint for all the bands
+        deltaphase = np.arctan2(psi_rpoint.imag, psi_rpoint.real)
+
+        # and the modulus of the wavefunction at the reference point rpoint (
+        # will be used to verify if the wavefunction at rpoint is significantly different from zero)
+        mod_rpoint = np.absolute(psi_rpoint)
+
+        for i in range(number_of_bands):
+            self.logger.debug(f"\t{nk_point:6d}  {(i + initial_band):4d}  {mod_rpoint[i]:12.8f}  {deltaphase[i]:12.8f}   {not mod_rpoint[i] < 1e-5}")
+
+        # Subtract the reference phase for each band
+        psi *= np.exp(-1j * deltaphase)[:, np.newaxis, np.newaxis]
+
+        return psi
+
+    def _save_bands(self, nk_point: int, initial_band: int, psi: np.ndarray):
+        """Saves one file per band (and spinor component), as the original generatewfc."""
+        for i in range(psi.shape[0]):
+            for s in range(psi.shape[1]):
+                suffix = f"-{s}" if m.noncolin else ""
+                filename = os.path.join(m.wfcdirectory, f"k0{nk_point}b0{i + initial_band}{suffix}.wfc")
+                # A new file replaces the old one, a reader never sees it half written
+                with open(filename + ".tmp", "wb") as fich:
+                    np.save(fich, psi[i, s])
+                    ready.sync(fich)
+                os.replace(filename + ".tmp", filename)
+        ready.fsync_directory(m.wfcdirectory)   # the renames are durable before the marker
+
+
+if __name__ == "__main__":
+    x = WfcGenerator()
+    start_time = time.time()
+    x.run()
+    end_time = time.time()
+    print('total generate time:', end_time-start_time)
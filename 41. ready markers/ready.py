@@ -0,0 +1,105 @@
+"""Per k-point readiness markers of the wavefunction store.
+
+The generator commits a k-point by first making its data durable (flush and
+fsync) and then creating an empty marker file with an atomic rename, so a
+marker never exists for data that is not completely on disk, even after a
+crash.  A consumer only reads the k-points whose marker exists.
+
+Every generation is an epoch: clear() publishes a new token (its start time
+and the pid of the generator) in ready/epoch, every marker holds the token of
+the generation that wrote it and finish() records that the generation ended.
+Markers of another epoch are ignored, so a consumer never mixes the data of
+two generations.
+"""
+
+from time import time_ns
+from typing import Optional, Set, Tuple
+import os
+
+try:
+    import berry._subroutines.loadmeta as m
+except:
+    pass
+
+READY_DIR = "ready"
+EPOCH_FILE = "epoch"
+FINISHED_FILE = "finished"
+
+
+def _directory() -> str:
+    return os.path.join(m.wfcdirectory, READY_DIR)
+
+
+def fsync_directory(path: str) -> None:
+    """Makes the entries of a directory (new names, renames) durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _publish(path: str, content: str) -> None:
+    """Atomically creates (or replaces) a small durable file."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fich:
+        fich.write(content)
+        sync(fich)
+    os.replace(tmp, path)
+    fsync_directory(os.path.dirname(path))
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as fich:
+            return fich.read()
+    except FileNotFoundError:
+        return None
+
+
+def clear() -> str:
+    """Removes all the markers and starts a new epoch, before a new generation; returns its token."""
+    os.makedirs(_directory(), exist_ok=True)
+    for name in os.listdir(_directory()):
+        os.remove(os.path.join(_directory(), name))
+    token = f"{time_ns()}-{os.getpid()}"
+    _publish(os.path.join(_directory(), EPOCH_FILE), token)
+    return token
+
+
+def epoch() -> Optional[Tuple[str, int, bool]]:
+    """Token of the current generation, when it started (ns) and whether it finished."""
+    token = _read(os.path.join(_directory(), EPOCH_FILE))
+    if token is None:
+        return None
+    return token, int(token.split("-")[0]), _read(os.path.join(_directory(), FINISHED_FILE)) == token
+
+
+def mark_ready(nk: int, token: str) -> None:
+    """Atomically publishes k-point nk for the epoch token; its data must already be durable."""
+    os.makedirs(_directory(), exist_ok=True)
+    _publish(os.path.join(_directory(), f"k0{nk}.ready"), token)
+
+
+def finish(token: str) -> None:
+    """Records that the generation of epoch token wrote all its k-points."""
+    _publish(os.path.join(_directory(), FINISHED_FILE), token)
+
+
+def ready(token: Optional[str] = None) -> Set[int]:
+    """k-points already committed in the epoch token (the current one by default)."""
+    if not os.path.isdir(_directory()):
+        return set()
+    if token is None:
+        current = epoch()
+        if current is None:
+            return set()
+        token = current[0]
+    return {int(name[2:-6]) for name in os.listdir(_directory())
+            if name.startswith("k0") and name.endswith(".ready") and _read(os.path.join(_directory(), name)) == token}
+
+
+def sync(fich) -> None:
+    """Flushes an open file to the disk."""
+    fich.flush()
+    os.fsync(fich.fileno())
@@ -0,0 +1,237 @@
+from multiprocessing import Pool, Array
+from typing import Tuple
+import hashlib
+import os
+from time import time
+import ctypes
+import logging
+
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.edges as e
+except:
+    pass
+
+
+def load_block(nk: int) -> np.ndarray:
+    """All the bands of k-point nk as one (nbnd, nr) block, (nbnd, 2 * nr) with both spinor components."""
+    if m.noncolin:  # Noncolinear case
+        return np.array([
+            np.concatenate((np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-0.wfc")),
+                            np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-1.wfc"))))
+            for band in range(m.nbnd)
+        ])
+
+    # Non-relativistic case
+    wfc = np.load(os.path.join(m.wfcdirectory, "wfc.npy"), mmap_mode="r")
+    size = m.nbnd * m.nr
+    return np.array(wfc[nk * size : (nk + 1) * size]).reshape(m.nbnd, m.nr)
+
+
+def block_hash(nk: int) -> bytes:
+    """Content hash of the k-block of nk."""
+    return hashlib.blake2b(np.ascontiguousarray(load_block(nk)).view(np.uint8), digest_size=32).digest()
+
+
+def setup_hash() -> bytes:
+    """Hash of everything else dpc depends on: sizes, neighbors and phases."""
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(np.array([m.nks, m.nbnd, m.nr, m.dimensions, int(m.noncolin)], dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(d.neighbors, dtype=np.int64).tobytes())
+    phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")), mmap_mode="r")
+    for nk in range(phase.shape[1]):
+        digest.update(np.ascontiguousarray(phase[:, nk]).view(np.uint8))
+    return digest.digest()
+
+
+def _stamp(filename: str) -> np.ndarray:
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_previous(hashes_file: str, dpc_shape: Tuple[int, ...]):
+    """dpc and hashes of the previous run, or None if they can not be reused.
+
+    The hashes only describe the dpc.npy they were written with (same size and
+    modification time); a dpc.npy saved later by any other run is not reused.
+    """
+    dpc_file = os.path.join(m.data_dir, "dpc.npy")
+    try:
+        with np.load(hashes_file) as previous:
+            setup, kblocks, stamp = previous["setup"].tobytes(), [row.tobytes() for row in previous["kblocks"]], previous["stamp"]
+        if not np.array_equal(stamp, _stamp(dpc_file)):
+            return None
+        dpc = np.load(dpc_file)
+    except (OSError, KeyError, ValueError):
+        return None
+    if dpc.shape != dpc_shape or len(kblocks) != m.nks:
+        return None
+    return setup, kblocks, dpc
+
+
+def phase_groups(table: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups the edges by the step between the two k-points on the grid.
+
+    On a regular grid the phase difference exp(i r.(k - k')) only depends on
+    k - k', i.e. on the direction j (and on the wrap, for neighbors across the
+    border of the grid).  Returns the group of every edge and one
+    representative edge (nk, neighbor) per group.
+    """
+    steps = d.nktoijl[table[:, 2]] - d.nktoijl[table[:, 0]]
+    _, first, group = np.unique(steps, axis=0, return_index=True, return_inverse=True)
+    return group.reshape(-1), table[first][:, [0, 2]]
+
+
+def direction_phases(representatives: np.ndarray, table: np.ndarray, group: np.ndarray, stride: int = 97) -> np.ndarray:
+    """conj(dphase) of every group, (nr, ngroups) (twice as long with spinors).
+
+    Every edge is checked against the phase of its group on one point out of
+    `stride`, so a grid that is not regular is caught here.
+    """
+    phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")), mmap_mode="r")
+    nks, neighbors = representatives.T
+    dphase = (np.array(phase[:, nks]) * np.array(phase[:, neighbors]).conj()).conj()
+
+    sample = phase[::stride]        # a view of the memmap, only the columns of each chunk are read
+    for first in range(0, len(table), 64):     # 64 edges at a time, to bound the temporaries
+        rows = table[first : first + 64]
+        error = np.max(np.abs((sample[:, rows[:, 0]] * sample[:, rows[:, 2]].conj()).conj() - dphase[::stride, group[first : first + 64]]), axis=0)
+        if np.any(error > 1e-8):
+            nk, _, neighbor, _ = rows[np.argmax(error)]
+            raise ValueError(f"The phase of the edge ({nk}, {neighbor}) differs from its direction by {error.max():.2e}, the k-grid is not regular")
+
+    if m.noncolin:
+        dphase = np.concatenate((dphase, dphase))
+    return dphase
+
+
+def dot_kpoint(nk: int, js: np.ndarray, neighbors: np.ndarray, jNeighbors: np.ndarray, groups: np.ndarray) -> None:
+    """Overlaps of k-point nk with all its forward neighbors in one matrix product.
+
+    The neighbor blocks, times the conjugate of the phase difference of their
+    direction, are stacked in a (len(edges) * nbnd, nr) matrix so that
+        Psi_nk @ B^H = [Psi_nk diag(dphase_j) Psi_j^H for j in edges]
+    """
+    wfcnk = load_block(nk)
+    stacked = np.concatenate([load_block(neighbor) * dphase_conj[:, g] for neighbor, g in zip(neighbors, groups)])
+
+    # not normalized dot product, (nbnd, len(edges) * nbnd) -> (len(edges), nbnd, nbnd)
+    overlaps = (wfcnk @ stacked.conj().T).reshape(m.nbnd, len(js), m.nbnd).transpose(1, 0, 2)
+    dpc[nk, js] = overlaps
+    dpc[neighbors, jNeighbors] = overlaps.conj().transpose(0, 2, 1)
+
+
+def dot(start: int, end: int) -> None:
+    """Overlaps of the rows start:end of the edge table, one k-point after the other."""
+    begin = time()
+
+    rows = table[start:end]
+    bounds = np.flatnonzero(np.diff(rows[:, 0], append=-1)) + 1
+    for first, last in zip(np.append(0, bounds[:-1]), bounds):
+        nk, js, neighbors, jNeighbors = rows[first, 0], rows[first:last, 1], rows[first:last, 2], rows[first:last, 3]
+        dot_kpoint(nk, js, neighbors, jNeighbors, group[start + first : start + last])
+
+    logger.debug(f"\tFinished k-points: {table[start, 0]:>4} to {table[end - 1, 0]:>4}\tin: {(time() - begin):>4.2f} seconds")
+
+def run_dot(npr: int = 1, incremental: bool = True, logger_name: str = "dot", logger_level: logging = logging.INFO, flush: bool = False):
+    global dpc, logger, dphase_conj, table, group
+    logger = log(logger_name, "DOT PRODUCT", level=logger_level, flush=flush)
+
+    if not 0 < npr <= os.cpu_count():
+        raise ValueError(f"npr must be between 1 and {os.cpu_count()}")
+
+    logger.header()
+
+    ###########################################################################
+    # 1. DEFINING THE CONSTANTS
+    ###########################################################################
+    DPC_SIZE = m.nks * 2 * m.dimensions * m.nbnd * m.nbnd
+    DPC_SHAPE = (m.nks, 2 * m.dimensions, m.nbnd, m.nbnd)
+
+    ###########################################################################
+    # 2. STDOUT THE PARAMETERS
+    ###########################################################################
+    logger.info(f"\tUnique reference of run: {m.refname}")
+    logger.info(f"\tNumber of processors to use: {npr}")
+    logger.info(f"\tNumber of bands: {m.nbnd}")
+    logger.info(f"\tTotal number of k-points: {m.nks}")
+    logger.info(f"\tTotal number of points in real space: {m.nr}")
+    logger.info(f"\tDirectory where the wfc are: {m.wfcdirectory}")
+    logger.info(f"\tReuse the dot products of unchanged k-points: {incremental}\n")
+
+    ###########################################################################
+    # 3. CREATE ALL THE ARRAYS
+    ###########################################################################
+    dpc_base = Array(ctypes.c_double, 2 * DPC_SIZE, lock=False)
+    dpc = np.frombuffer(dpc_base, dtype=np.complex128).reshape(DPC_SHAPE)
+    dp = np.zeros(DPC_SHAPE, dtype=np.float64)
+
+    table = e.load()        # Forward edges (nk, j, neighbor, jNeighbor), sorted by nk
+
+    # The phase differences, one per direction, are computed once here and
+    # shared (read-only, inherited by the forked workers) instead of phase.npy
+    group, representatives = phase_groups(table)
+    dphase_conj = direction_phases(representatives, table, group)
+    logger.info(f"\tPhase differences: {len(representatives)} for {len(table)} edges")
+
+    # Content hash of every k-block; only the edges of changed k-points are computed
+    hashes_file = os.path.join(m.data_dir, "dpc_hashes.npz")
+    with Pool(npr) as pool:
+        kblocks = pool.map(block_hash, range(m.nks))
+    setup = setup_hash()
+
+    previous = load_previous(hashes_file, DPC_SHAPE) if incremental else None
+    if previous is not None and previous[0] == setup:
+        changed = np.array([new != old for new, old in zip(kblocks, previous[1])])
+    else:
+        changed = np.ones(m.nks, dtype=bool)
+        previous = None
+    selected = changed[table[:, 0]] | changed[table[:, 2]]
+    reused = table[~selected]
+    table, group = table[selected], group[selected]
+    logger.info(f"\tChanged k-points: {np.sum(changed)} of {m.nks}\tedges to compute: {len(table)} (reused: {len(reused)})")
+
+    ###########################################################################
+    # 4. CALCULATE
+    ###########################################################################
+    # A few large contiguous chunks of the edge table per processor
+    if len(table):
+        with Pool(npr) as pool:
+            pool.starmap(dot, e.chunks(table, 4 * npr))
+
+    dpc /= m.nr         # To normalize the dot product
+    if previous is not None:
+        dpc[reused[:, 0], reused[:, 1]] = previous[2][reused[:, 0], reused[:, 1]]
+        dpc[reused[:, 2], reused[:, 3]] = previous[2][reused[:, 2], reused[:, 3]]
+    dp = np.abs(dpc)    # Calculate the modulus of the dot product
+
+    ###########################################################################
+    # 5. SAVE OUTPUT
+    ###########################################################################
+    # The hashes are removed first and written last, so after an interrupted
+    # save the next run recomputes everything
+    if os.path.exists(hashes_file):
+        os.remove(hashes_file)
+    np.save(os.path.join(m.data_dir, "dpc.npy"), dpc)
+    np.save(os.path.join(m.data_dir, "dp.npy"), dp)
+    np.savez(hashes_file, setup=np.frombuffer(setup, dtype=np.uint8),
+             kblocks=np.array([np.frombuffer(h, dtype=np.uint8) for h in kblocks]),
+             stamp=_stamp(os.path.join(m.data_dir, "dpc.npy")))
+    logger.info(f"\n\tDot products saved to file dpc.npy")
+    logger.info(f"\tDot products modulus saved to file dp.npy")
+
+    ###########################################################################
+    # Finished
+    ###########################################################################
+    logger.footer()
+
+if __name__ == "__main__":
+    start_timef = time()
+    run_dot()
+    end_timef = time()
+    print('total dot time:', end_timef-start_timef)
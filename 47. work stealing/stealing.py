@@ -0,0 +1,87 @@
+"""Work-stealing scheduler for a list of independent tasks, over forked processes.
+
+Tasks are first dealt to the workers by their estimated cost (largest first,
+each to the least loaded worker).  A worker takes its tasks from the front of
+its own queue; when it is empty it steals from the back (the cheapest tasks)
+of the queue with the most estimated work left.  The queues are index ranges
+in shared memory, protected by one lock.
+"""
+
+from multiprocessing import Array, Lock, Process
+from time import time
+from typing import Callable, List, Sequence
+
+import numpy as np
+
+# Columns of the statistics of every worker
+STATS = ("tasks", "stolen", "busy", "wall")
+
+
+def deal(costs: np.ndarray, nworkers: int) -> List[List[int]]:
+    """Tasks of every worker, largest first, balancing the estimated cost."""
+    queues = [[] for _ in range(nworkers)]
+    load = np.zeros(nworkers)
+    for task in np.argsort(-costs, kind="stable"):
+        worker = int(np.argmin(load))
+        queues[worker].append(int(task))
+        load[worker] += costs[task]
+    return queues
+
+
+def _worker(w: int, run: Callable[[int], None], order, costs, head, tail, left, lock, stats) -> None:
+    start = time()
+    busy = 0.0
+    while True:
+        with lock:
+            if head[w] < tail[w]:           # own queue, from the front
+                owner = w
+                i = head[w]
+                head[w] += 1
+            else:                           # steal from the back of the busiest queue
+                victims = [v for v in range(len(head)) if head[v] < tail[v]]
+                if not victims:
+                    break
+                owner = max(victims, key=lambda v: left[v])
+                tail[owner] -= 1
+                i = tail[owner]
+            task = order[i]
+            left[owner] -= costs[task]
+        stolen = owner != w
+
+        begin = time()
+        run(task)
+        busy += time() - begin
+        stats[len(STATS) * w] += 1
+        stats[len(STATS) * w + 1] += stolen
+
+    stats[len(STATS) * w + 2] = busy
+    stats[len(STATS) * w + 3] = time() - start
+
+
+def run_tasks(run: Callable[[int], None], costs: Sequence[float], nworkers: int) -> np.ndarray:
+    """Runs run(task) for every task in nworkers forked processes.
+
+    Returns the statistics (tasks, stolen, busy seconds, wall seconds) of every worker.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    queues = deal(costs, nworkers)
+    bounds = np.cumsum([0] + [len(q) for q in queues])
+
+    order = Array("l", [task for q in queues for task in q], lock=False)
+    head = Array("l", bounds[:-1].tolist(), lock=False)
+    tail = Array("l", bounds[1:].tolist(), lock=False)
+    left = Array("d", [float(costs[q].sum()) for q in queues], lock=False)
+    stats = Array("d", len(STATS) * nworkers, lock=False)
+    lock = Lock()
+    shared_costs = Array("d", costs.tolist(), lock=False)
+
+    workers = [Process(target=_worker, args=(w, run, order, shared_costs, head, tail, left, lock, stats))
+               for w in range(nworkers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError(f"Worker(s) failed with exit codes {[worker.exitcode for worker in workers]}")
+
+    return np.frombuffer(stats, dtype=np.float64).reshape(nworkers, len(STATS)).copy()
@@ -0,0 +1,208 @@
+from typing import Dict, Tuple
+import os
+from time import time
+import logging
+
+import numpy as np
+
+from berry import log
+
+try:
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.edges as e
+except:
+    pass
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+# Run with, for example:  mpirun -np 4 python dotproduct48.py
+
+
+def load_block(nk: int) -> np.ndarray:
+    """All the bands of k-point nk as one (nbnd, nr) block, (nbnd, 2 * nr) with both spinor components."""
+    if m.noncolin:  # Noncolinear case
+        return np.array([
+            np.concatenate((np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-0.wfc")),
+                            np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-1.wfc"))))
+            for band in range(m.nbnd)
+        ])
+
+    # Non-relativistic case
+    wfc = np.load(os.path.join(m.wfcdirectory, "wfc.npy"), mmap_mode="r")
+    size = m.nbnd * m.nr
+    return np.array(wfc[nk * size : (nk + 1) * size]).reshape(m.nbnd, m.nr)
+
+
+def phase_groups(table: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups the edges by the step between the two k-points on the grid.
+
+    On a regular grid the phase difference exp(i r.(k - k')) only depends on
+    k - k', i.e. on the direction j (and on the wrap, for neighbors across the
+    border of the grid).  Returns the group of every edge and one
+    representative edge (nk, neighbor) per group.
+    """
+    steps = d.nktoijl[table[:, 2]] - d.nktoijl[table[:, 0]]
+    _, first, group = np.unique(steps, axis=0, return_index=True, return_inverse=True)
+    return group.reshape(-1), table[first][:, [0, 2]]
+
+
+def direction_phases(representatives: np.ndarray, table: np.ndarray, group: np.ndarray, stride: int = 97) -> np.ndarray:
+    """conj(dphase) of every group, (nr, ngroups) (twice as long with spinors).
+
+    Every edge is checked against the phase of its group on one point out of
+    `stride`, so a grid that is not regular is caught here.
+    """
+    phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")), mmap_mode="r")
+    nks, neighbors = representatives.T
+    dphase = (np.array(phase[:, nks]) * np.array(phase[:, neighbors]).conj()).conj()
+
+    sample = phase[::stride]        # a view of the memmap, only the columns of each chunk are read
+    for first in range(0, len(table), 64):     # 64 edges at a time, to bound the temporaries
+        rows = table[first : first + 64]
+        error = np.max(np.abs((sample[:, rows[:, 0]] * sample[:, rows[:, 2]].conj()).conj() - dphase[::stride, group[first : first + 64]]), axis=0)
+        if np.any(error > 1e-8):
+            nk, _, neighbor, _ = rows[np.argmax(error)]
+            raise ValueError(f"The phase of the edge ({nk}, {neighbor}) differs from its direction by {error.max():.2e}, the k-grid is not regular")
+
+    if m.noncolin:
+        dphase = np.concatenate((dphase, dphase))
+    return dphase
+
+
+def owners(nranks: int) -> np.ndarray:
+    """Rank that owns every k-point: contiguous slabs of the k-grid (along l, then j), the same number of k-points per rank."""
+    order = np.lexsort(d.nktoijl.T)
+    owner = np.empty(m.nks, dtype=np.int64)
+    for rank, part in enumerate(np.array_split(order, nranks)):
+        owner[part] = rank
+    return owner
+
+
+def exchange_halo(comm, owner: np.ndarray, blocks: Dict[int, np.ndarray]) -> int:
+    """Sends the owned k-blocks that other ranks need for their edges and receives the ones this rank needs.
+
+    The forward edges of nk are computed by the owner of nk, so the owner of a
+    neighbor in another patch sends it there.  Returns the bytes received.
+    """
+    rank = comm.Get_rank()
+    shape = (m.nbnd, (2 if m.noncolin else 1) * m.nr)
+    cross = table[owner[table[:, 0]] != owner[table[:, 2]]]
+    # (k-point, destination) pairs, each block once per destination
+    pairs = np.unique(np.stack((cross[:, 2], owner[cross[:, 0]]), axis=1), axis=0)
+
+    # The pairs are sorted by k-point on every rank, and messages between two
+    # ranks arrive in the order they were sent, so no tags are needed
+    requests = [comm.Isend(blocks[nk], dest=int(dest)) for nk, dest in pairs if owner[nk] == rank]
+    received = 0
+    for nk, dest in pairs:
+        if dest == rank:
+            blocks[nk] = np.empty(shape, dtype=np.complex128)
+            comm.Recv(blocks[nk], source=int(owner[nk]))
+            received += blocks[nk].nbytes
+    MPI.Request.Waitall(requests)
+    return received
+
+
+def dot_kpoint(nk: int, js: np.ndarray, neighbors: np.ndarray, jNeighbors: np.ndarray, groups: np.ndarray,
+               blocks: Dict[int, np.ndarray]) -> None:
+    """Overlaps of k-point nk with all its forward neighbors in one matrix product.
+
+    The neighbor blocks, times the conjugate of the phase difference of their
+    direction, are stacked in a (len(edges) * nbnd, nr) matrix so that
+        Psi_nk @ B^H = [Psi_nk diag(dphase_j) Psi_j^H for j in edges]
+    """
+    stacked = np.concatenate([blocks[neighbor] * dphase_conj[:, g] for neighbor, g in zip(neighbors, groups)])
+
+    # not normalized dot product, (nbnd, len(edges) * nbnd) -> (len(edges), nbnd, nbnd)
+    overlaps = (blocks[nk] @ stacked.conj().T).reshape(m.nbnd, len(js), m.nbnd).transpose(1, 0, 2)
+    dpc[nk, js] = overlaps
+    dpc[neighbors, jNeighbors] = overlaps.conj().transpose(0, 2, 1)
+
+
+def run_dot(logger_name: str = "dot", logger_level: logging = logging.INFO, flush: bool = False):
+    global dpc, logger, dphase_conj, table, group
+    if MPI is None:
+        raise ImportError("The distributed dot product needs mpi4py")
+
+    comm = MPI.COMM_WORLD
+    rank, nranks = comm.Get_rank(), comm.Get_size()
+    # Only rank 0 writes to the log
+    logger = log(logger_name, "DOT PRODUCT", level=logger_level if rank == 0 else logging.CRITICAL, flush=flush)
+
+    if rank == 0:
+        logger.header()
+
+    ###########################################################################
+    # 1. DEFINING THE CONSTANTS
+    ###########################################################################
+    DPC_SHAPE = (m.nks, 2 * m.dimensions, m.nbnd, m.nbnd)
+
+    ###########################################################################
+    # 2. STDOUT THE PARAMETERS
+    ###########################################################################
+    logger.info(f"\tUnique reference of run: {m.refname}")
+    logger.info(f"\tNumber of MPI ranks: {nranks}")
+    logger.info(f"\tNumber of bands: {m.nbnd}")
+    logger.info(f"\tTotal number of k-points: {m.nks}")
+    logger.info(f"\tTotal number of points in real space: {m.nr}")
+    logger.info(f"\tDirectory where the wfc are: {m.wfcdirectory}\n")
+
+    ###########################################################################
+    # 3. CREATE ALL THE ARRAYS
+    ###########################################################################
+    start = time()
+    dpc = np.zeros(DPC_SHAPE, dtype=np.complex128)     # only the slices of this rank are filled
+    table = e.load() if rank == 0 else None             # rank 0 builds (or reads) the cached table
+    table = comm.bcast(table, root=0)
+    group, representatives = phase_groups(table)
+    dphase_conj = direction_phases(representatives, table, group)
+
+    # Every rank reads only the k-points it owns, then the halo of its cross-patch edges
+    owner = owners(nranks)
+    blocks = {nk: load_block(nk) for nk in np.flatnonzero(owner == rank)}
+    received = exchange_halo(comm, owner, blocks)
+
+    ###########################################################################
+    # 4. CALCULATE
+    ###########################################################################
+    rows = np.flatnonzero(owner[table[:, 0]] == rank)
+    for nk in np.unique(table[rows, 0]):
+        own = rows[table[rows, 0] == nk]
+        dot_kpoint(nk, table[own, 1], table[own, 2], table[own, 3], group[own], blocks)
+
+    stats = comm.gather((len(blocks) - int(np.sum(owner == rank)), received, len(rows), time() - start), root=0)
+    for r, (halo, nbytes, nedges, seconds) in enumerate(stats or []):
+        logger.info(f"\tRank {r:>4}: {int(np.sum(owner == r)):>5} k-points\thalo: {halo:>4} ({nbytes / 1024 ** 2:.1f} MiB)\tedges: {nedges:>6}\tin: {seconds:>6.2f} seconds")
+
+    # Every slice of dpc is filled by exactly one rank
+    total = np.zeros(DPC_SHAPE, dtype=np.complex128) if rank == 0 else None
+    comm.Reduce(dpc, total, op=MPI.SUM, root=0)
+
+    if rank == 0:
+        dpc = total
+        dpc /= m.nr         # To normalize the dot product
+        dp = np.abs(dpc)    # Calculate the modulus of the dot product
+
+        ###########################################################################
+        # 5. SAVE OUTPUT
+        ###########################################################################
+        np.save(os.path.join(m.data_dir, "dpc.npy"), dpc)
+        np.save(os.path.join(m.data_dir, "dp.npy"), dp)
+        logger.info(f"\n\tDot products saved to file dpc.npy")
+        logger.info(f"\tDot products modulus saved to file dp.npy")
+
+        ###########################################################################
+        # Finished
+        ###########################################################################
+        logger.footer()
+
+if __name__ == "__main__":
+    start_timef = time()
+    run_dot()
+    end_timef = time()
+    if MPI.COMM_WORLD.Get_rank() == 0:
+        print('total dot time:', end_timef-start_timef)
@@ -0,0 +1,110 @@
+"""Overlaps <psi_nk1|psi_nk2> for arbitrary pairs of k-points, on demand.
+
+run_dot only gives the nearest neighbors, dpc[nk, j] for j < 2 * dimensions.
+Wilson loops along arbitrary paths or second neighbor finite differences need
+other pairs; OverlapService computes them from the same store (wfc.npy or the
+per band files, and phase.npy) without the full dpc:
+
+    service = OverlapService(cache_mb=512)
+    m01 = service.overlap(0, 1)                      # (nbnd, nbnd), as dpc[0, j]
+    loop = service.overlaps([(0, 1), (1, 7), (7, 6), (6, 0)])
+
+With the phase folded in each block, a_k = psi_k exp(i k.r), the overlap is
+    a_nk1 @ a_nk2^H / nr  =  sum_r psi_nk1 conj(psi_nk2) exp(i (k1 - k2).r) / nr
+the same normalized value as dpc.  The blocks are kept in a KBlockCache and
+the results in a bounded LRU memo; overlap(nk2, nk1) is served from the memo
+of (nk1, nk2) as its conjugate transpose.
+"""
+
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+import os
+
+import numpy as np
+
+try:
+    import berry._subroutines.loadmeta as m
+    import berry._subroutines.loaddata as d
+    import berry._subroutines.kcache as kc
+except:
+    pass
+
+
+def load_block(nk: int) -> np.ndarray:
+    """Reads all the bands of k-point nk as one (nbnd, nr) block, (nbnd, 2 * nr) with both spinor components."""
+    if m.noncolin:  # Noncolinear case
+        return np.array([
+            np.concatenate((np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-0.wfc")),
+                            np.load(os.path.join(m.wfcdirectory, f"k0{nk}b0{band}-1.wfc"))))
+            for band in range(m.nbnd)
+        ])
+
+    # Non-relativistic case
+    wfc = np.load(os.path.join(m.wfcdirectory, "wfc.npy"), mmap_mode="r")
+    size = m.nbnd * m.nr
+    return np.array(wfc[nk * size : (nk + 1) * size]).reshape(m.nbnd, m.nr)
+
+
+class OverlapService:
+    def __init__(self, cache_mb: float = 512, max_pairs: int = 4096):
+        self.phase = np.load(os.path.join(m.workdir, os.path.join(m.data_dir, "phase.npy")), mmap_mode="r")
+        self.blocks = kc.KBlockCache(int(cache_mb * 1024 ** 2), self.load)
+        self.max_pairs = max_pairs
+        self.memo = OrderedDict()
+        self.hits = 0
+        self.computed = 0
+
+    def load(self, nk: int) -> np.ndarray:
+        """Block of k-point nk with its phase folded in."""
+        if not 0 <= nk < m.nks:
+            raise ValueError(f"k-point {nk} is out of range, there are {m.nks} k-points")
+        phase = np.array(self.phase[:, nk])
+        if m.noncolin:
+            phase = np.concatenate((phase, phase))
+        return load_block(nk) * phase
+
+    def overlap(self, nk1: int, nk2: int) -> np.ndarray:
+        """Normalized (nbnd, nbnd) overlap matrix of k-points nk1 and nk2."""
+        return self.overlaps([(nk1, nk2)])[0]
+
+    def overlaps(self, pairs: Iterable[Tuple[int, int]]) -> List[np.ndarray]:
+        """Overlap matrices of many pairs, in the order given.
+
+        The pairs missing from the memo are grouped by their first k-point,
+        so each group is one matrix product with the other blocks stacked and
+        every block is read at most once per call (while it fits the cache).
+        """
+        pairs = [(int(nk1), int(nk2)) for nk1, nk2 in pairs]
+        keys = [(min(pair), max(pair)) for pair in pairs]
+
+        missing = {}
+        for key in dict.fromkeys(keys):
+            if key in self.memo:
+                self.hits += 1
+                self.memo.move_to_end(key)
+            else:
+                missing.setdefault(key[0], []).append(key[1])
+
+        results = {key: self.memo[key] for key in keys if key in self.memo}
+        for nk1, others in missing.items():
+            stacked = np.concatenate([self.blocks[nk2] for nk2 in others])
+            # (nbnd, len(others) * nbnd) -> (len(others), nbnd, nbnd)
+            overlaps = (self.blocks[nk1] @ stacked.conj().T).reshape(m.nbnd, len(others), m.nbnd).transpose(1, 0, 2) / m.nr
+            for nk2, matrix in zip(others, overlaps):
+                results[(nk1, nk2)] = self.store((nk1, nk2), np.ascontiguousarray(matrix))
+            self.computed += len(others)
+
+        # copies, so the caller can change them (e.g. normalize a link in place) without touching the memo
+        return [results[key].copy() if pair == key else results[key].conj().T for pair, key in zip(pairs, keys)]
+
+    def store(self, key: Tuple[int, int], matrix: np.ndarray) -> np.ndarray:
+        matrix.setflags(write=False)
+        self.memo[key] = matrix
+        while len(self.memo) > self.max_pairs:
+            self.memo.popitem(last=False)
+        return matrix
+
+    def stats(self) -> Tuple[int, int, int, int]:
+        """Memo hits, overlaps computed, and block cache hits and misses."""
+        hits, misses, _ = self.blocks.stats()
+        return self.hits, self.computed, hits, misses